@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the search strategies used by Flask-Whooshee.
+
+These are too slow to run as part of the test suite, run them by hand::
+
+    $ python benchmark.py ngram --docs 1000000
+    $ python benchmark.py mmap --docs 1000000
+"""
+
+import argparse
+import random
+import shutil
+import string
+import tempfile
+import time
+
+import whoosh.fields
+import whoosh.index
+import whoosh.qparser
+from whoosh.filedb.filestore import FileStorage
+
+
+def make_words(count, rnd):
+    words = set()
+    while len(words) < count:
+        words.add(u''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(5, 10))))
+    return sorted(words)
+
+
+def build_index(path, schema, docs, words, rnd, procs):
+    index = whoosh.index.create_in(path, schema)
+    writer = index.writer(limitmb=256, procs=procs, multisegment=procs > 1)
+    for docnum in range(docs):
+        writer.add_document(id=docnum, title=u' '.join(rnd.sample(words, 6)))
+    writer.commit()
+    return index
+
+
+def time_queries(index, search_strings):
+    timings = []
+    with index.searcher() as searcher:
+        parser = whoosh.qparser.MultifieldParser(['title'], index.schema, group=whoosh.qparser.OrGroup)
+        for search_string in search_strings:
+            start = time.time()
+            query = parser.parse(search_string)
+            [hit['id'] for hit in searcher.search(query, limit=10)]
+            timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95)]
+
+
+def bench_ngram(args):
+    """Leading-wildcard substring search against n-gram term lookups.
+
+    Compares TEXT fields searched by ``*word*`` queries (what
+    ``match_substrings=True`` does) with NGRAMWORDS fields searched by plain
+    terms (what ``register_model(..., ngram=(2, 4))`` does).
+    """
+    rnd = random.Random(args.seed)
+    words = make_words(args.words, rnd)
+    substrings = [w[1:4] for w in rnd.sample(words, args.queries)]
+    variants = [
+        ('wildcard', whoosh.fields.TEXT(), [u'*{0}*'.format(s) for s in substrings]),
+        ('ngram', whoosh.fields.NGRAMWORDS(2, 4), substrings),
+    ]
+    for name, field, search_strings in variants:
+        path = tempfile.mkdtemp()
+        try:
+            schema = whoosh.fields.Schema(id=whoosh.fields.NUMERIC(stored=True, unique=True), title=field)
+            start = time.time()
+            index = build_index(path, schema, args.docs, words, random.Random(args.seed), args.procs)
+            built = time.time() - start
+            median, p95 = time_queries(index, search_strings)
+            print('{0:10} indexing {1:8.1f}s   search median {2:8.2f}ms   p95 {3:8.2f}ms'.format(
+                name, built, median * 1000, p95 * 1000))
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def bench_mmap(args):
+    """Searching memory-mapped segment files against reading them.
+
+    Builds a single large segment and searches it with the index opened with
+    ``WHOOSHEE_STORAGE_OPTIONS = {'supports_mmap': True}`` (the default) and
+    ``{'supports_mmap': False}``.
+    """
+    rnd = random.Random(args.seed)
+    words = make_words(args.words, rnd)
+    search_strings = [u' '.join(rnd.sample(words, 2)) for _ in range(args.queries)]
+    path = tempfile.mkdtemp()
+    try:
+        schema = whoosh.fields.Schema(id=whoosh.fields.NUMERIC(stored=True, unique=True),
+                                      title=whoosh.fields.TEXT())
+        index = build_index(path, schema, args.docs, words, rnd, args.procs)
+        index.optimize()
+        size = sum(index.storage.file_length(name) for name in index.storage.list())
+        print('segment files {0:.1f} MB'.format(size / 1024.0 / 1024))
+        for supports_mmap in (True, False):
+            index = FileStorage(path, supports_mmap=supports_mmap).open_index()
+            median, p95 = time_queries(index, search_strings)
+            print('mmap {0!s:5}   search median {1:8.2f}ms   p95 {2:8.2f}ms'.format(
+                supports_mmap, median * 1000, p95 * 1000))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--docs', type=int, default=1000000, help='number of indexed documents')
+    parser.add_argument('--words', type=int, default=100000, help='size of the vocabulary')
+    parser.add_argument('--queries', type=int, default=200, help='number of timed searches')
+    parser.add_argument('--procs', type=int, default=1, help='number of indexing processes')
+    parser.add_argument('--seed', type=int, default=42)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    subparsers.add_parser('ngram', help=bench_ngram.__doc__.splitlines()[0]).set_defaults(func=bench_ngram)
+    subparsers.add_parser('mmap', help=bench_mmap.__doc__.splitlines()[0]).set_defaults(func=bench_mmap)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,25 @@
 import abc
+import datetime
+import enum
 import errno
 import os
+import json
 import re
+import shutil
+import socket
 import sys
+import tempfile
+import threading
+import time
+import uuid
 import warnings
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
 from inspect import isclass
+from urllib.parse import quote, unquote
 
 import sqlalchemy
-
-import whoosh
-import whoosh.fields
-import whoosh.index
-import whoosh.qparser
-from whoosh.filedb.filestore import RamStorage
+import sqlalchemy.orm
 
 from flask import current_app
 try:
@@ -20,15 +27,15 @@ try:
 except ImportError:
     from flask_sqlalchemy import BaseQuery as Query
 from sqlalchemy import text, event
-from sqlalchemy.inspection import inspect
-from sqlalchemy.orm.mapper import Mapper
-from sqlalchemy.orm.util import AliasedClass, AliasedInsp
 from sqlalchemy.orm import Query as SQLAQuery
-from sqlalchemy.types import Integer as SQLInteger, BigInteger as SQLBigInteger
-
+from sqlalchemy.types import Integer as SQLInteger, BigInteger as SQLBigInteger, \
+    Boolean as SQLBoolean, Date as SQLDate, DateTime as SQLDateTime, Enum as SQLEnum, \
+    Numeric as SQLNumeric
 
-from sqlalchemy.sql import visitors
-from sqlalchemy.sql.annotation import AnnotatedTable, AnnotatedAlias
+# whoosh and the SQLAlchemy helpers used only when searching are imported
+# lazily on first use, so that importing flask_whooshee stays cheap for
+# processes that never search (CLI tools, short lived workers, ...)
+# pylint: disable=import-outside-toplevel
 
 INSERT_KWD = 'insert'
 UPDATE_KWD = 'update'
@@ -37,6 +44,40 @@ DELETE_KWD = 'delete'
 
 __version__ = '0.9.1'
 
+# changes waiting to be indexed in the outbox mode, see `Whooshee.drain`
+outbox_metadata = sqlalchemy.MetaData()
+outbox_table = sqlalchemy.Table(
+    'whooshee_outbox', outbox_metadata,
+    sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('model', sqlalchemy.String(255), nullable=False),
+    sqlalchemy.Column('pk', sqlalchemy.String(255), nullable=False),
+    sqlalchemy.Column('operation', sqlalchemy.String(16), nullable=False),
+    # JSON of the partitions the record was indexed in before the change
+    sqlalchemy.Column('partitions', sqlalchemy.Text, nullable=True),
+    sqlalchemy.Column('created', sqlalchemy.DateTime, nullable=False,
+                      default=datetime.datetime.utcnow),
+)
+# index files and locks of the database storage, see `WHOOSHEE_DATABASE_STORAGE`
+files_table = sqlalchemy.Table(
+    'whooshee_files', outbox_metadata,
+    sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('index_name', sqlalchemy.String(255), nullable=False),
+    sqlalchemy.Column('name', sqlalchemy.String(255), nullable=False),
+    sqlalchemy.Column('size', sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column('modified', sqlalchemy.Float, nullable=False),
+    sqlalchemy.Column('data', sqlalchemy.LargeBinary, nullable=False),
+    sqlalchemy.UniqueConstraint('index_name', 'name'),
+)
+locks_table = sqlalchemy.Table(
+    'whooshee_locks', outbox_metadata,
+    sqlalchemy.Column('index_name', sqlalchemy.String(255), primary_key=True),
+    sqlalchemy.Column('name', sqlalchemy.String(255), primary_key=True),
+    sqlalchemy.Column('acquired', sqlalchemy.DateTime, nullable=False,
+                      default=datetime.datetime.utcnow),
+    # random token of the holder, so that a lock taken over isn't released by the previous holder
+    sqlalchemy.Column('owner', sqlalchemy.String(32), nullable=True),
+)
+
 
 def _get_app(obj):
     return (getattr(obj, 'app', None) or current_app)
@@ -44,6 +85,11 @@ def _get_app(obj):
 def _get_config(obj):
     return _get_app(obj).extensions['whooshee']
 
+def _get_engine(app):
+    # Flask-SQLAlchemy < 3 stores its state object instead of the extension
+    state = app.extensions['sqlalchemy']
+    return getattr(state, 'db', state).engine
+
 def _assure_dirs_exists(path):
     try:
         os.makedirs(path)
@@ -51,67 +97,940 @@ def _assure_dirs_exists(path):
         if err.errno != errno.EEXIST:
             raise
 
+def _to_text(value):
+    if sys.version < '3':
+        return unicode(value)
+    return str(value)
+
+def _typed_field(column_type):
+    """Returns the whoosh field type for indexing values of the given
+    SQLAlchemy column type, or ``None`` if they should be indexed as text.
+    """
+    import whoosh.fields
+
+    if isinstance(column_type, SQLBoolean):
+        return whoosh.fields.BOOLEAN()
+    # BigInteger is a subclass of Integer, so it needs to be checked first
+    if isinstance(column_type, SQLBigInteger):
+        return whoosh.fields.NUMERIC(bits=64)
+    if isinstance(column_type, SQLInteger):
+        return whoosh.fields.NUMERIC()
+    if isinstance(column_type, SQLNumeric):
+        return whoosh.fields.NUMERIC(numtype=float)
+    if isinstance(column_type, (SQLDate, SQLDateTime)):
+        return whoosh.fields.DATETIME()
+    if isinstance(column_type, SQLEnum):
+        return whoosh.fields.KEYWORD()
+    return None
+
+def _field_value(field, value):
+    """Converts a model attribute value to what the given (non-text) whoosh
+    field type expects.
+    """
+    import whoosh.fields
+
+    # DATETIME is a subclass of NUMERIC, so it needs to be checked first
+    if isinstance(field, whoosh.fields.DATETIME):
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime.combine(value, datetime.time())
+        return value
+    if isinstance(field, whoosh.fields.NUMERIC):
+        if not isinstance(value, (int, float)):
+            # e.g. Decimal
+            value = float(value)
+        return value
+    if isinstance(field, whoosh.fields.BOOLEAN):
+        return bool(value)
+    if isinstance(value, enum.Enum):
+        value = value.name
+    return _to_text(value)
+
+def _pushdown_filter(whereclause, whoosheer, with_rest=False):
+    """Translates the top level conditions of a SQL where clause that compare
+    a column with values (``==``, ``in_``, ``<``, ``<=``, ``>``, ``>=`` and
+    ``between``) into a whoosh query restricting the search results the same
+    way. Only columns indexed by model whoosheers in fields with exact values
+    (i.e. not ``TEXT`` or n-gram fields) are considered, all other conditions
+    are left to the database. Returns ``None`` if there is nothing to filter by.
+    With ``with_rest``, returns the query and the list of the conditions left
+    to the database.
+    """
+    import whoosh.fields
+    import whoosh.query
+    from sqlalchemy.sql import operators
+    from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList, \
+        False_, True_
+
+    if whereclause is None or not hasattr(whoosheer, '_is_model_whoosheer'):
+        rest = [whereclause] if whereclause is not None else []
+        return (None, rest) if with_rest else None
+    table = whoosheer.models[0].__table__
+    exact_types = (whoosh.fields.ID, whoosh.fields.KEYWORD, whoosh.fields.NUMERIC,
+                   whoosh.fields.BOOLEAN)
+
+    def value_of(field, value):
+        if value is None or isinstance(value, (list, tuple)):
+            return None
+        value = _field_value(field, value)
+        if isinstance(field, whoosh.fields.DATETIME):
+            return value
+        if isinstance(field, whoosh.fields.NUMERIC):
+            # e.g. `views < 10.5` can't be expressed by an integer range
+            if field.numtype is int and not isinstance(value, int):
+                return None
+            return value
+        if isinstance(field, whoosh.fields.BOOLEAN):
+            return value
+        tokens = list(field.process_text(value, mode='query'))
+        # values indexed as multiple terms can't be matched exactly
+        return tokens[0] if len(tokens) == 1 else None
+
+    def range_query(fname, field, start, end, startexcl, endexcl):
+        if isinstance(field, whoosh.fields.DATETIME):
+            return whoosh.query.DateRange(fname, start, end, startexcl, endexcl)
+        if isinstance(field, whoosh.fields.NUMERIC):
+            return whoosh.query.NumericRange(fname, start, end, startexcl, endexcl)
+        return None
+
+    def translate(clause):
+        if not isinstance(clause, BinaryExpression):
+            return None
+        column = clause.left
+        if getattr(column, 'table', None) is not table or column.name not in whoosheer.schema:
+            return None
+        fname = column.name
+        field = whoosheer.schema[fname]
+        if not isinstance(field, exact_types):
+            return None
+        op = clause.operator
+        if op is operators.between_op:
+            bounds = getattr(clause.right, 'clauses', ())
+            if len(bounds) != 2 or not all(isinstance(b, BindParameter) for b in bounds):
+                return None
+            start, end = [value_of(field, b.value) for b in bounds]
+            if start is None or end is None:
+                return None
+            return range_query(fname, field, start, end, False, False)
+        if isinstance(clause.right, (True_, False_)):
+            # `column == True` is compiled to a constant instead of a bound value
+            if op in (operators.eq, operators.is_) and isinstance(field, whoosh.fields.BOOLEAN):
+                return whoosh.query.Term(fname, isinstance(clause.right, True_))
+            return None
+        if not isinstance(clause.right, BindParameter):
+            return None
+        if op is operators.in_op:
+            values = [value_of(field, v) for v in clause.right.value or ()]
+            if any(v is None for v in values):
+                return None
+            return whoosh.query.Or([whoosh.query.Term(fname, v) for v in values])
+        value = value_of(field, clause.right.value)
+        if value is None:
+            return None
+        if op is operators.eq:
+            return whoosh.query.Term(fname, value)
+        if op is operators.lt:
+            return range_query(fname, field, None, value, False, True)
+        if op is operators.le:
+            return range_query(fname, field, None, value, False, False)
+        if op is operators.gt:
+            return range_query(fname, field, value, None, True, False)
+        if op is operators.ge:
+            return range_query(fname, field, value, None, False, False)
+        return None
+
+    if isinstance(whereclause, BooleanClauseList) and whereclause.operator is operators.and_:
+        clauses = whereclause.clauses
+    else:
+        clauses = [whereclause]
+    queries, rest = [], []
+    for clause in clauses:
+        query = translate(clause)
+        if query is None:
+            rest.append(clause)
+        else:
+            queries.append(query)
+    if not queries:
+        query = None
+    else:
+        query = whoosh.query.And(queries) if len(queries) > 1 else queries[0]
+    return (query, rest) if with_rest else query
+
+def _unique_field(whoosheer):
+    """Returns the name of the unique field of the whoosheer's schema."""
+    # TODO what if unique field doesn't exist or there are multiple?
+    for fname, field in list(whoosheer.schema._fields.items()):
+        if field.unique:
+            uniq = fname
+    return uniq
+
+def _segment_id(searcher):
+    """Returns the id of the index segment searched by the (leaf) searcher,
+    or ``None`` if it doesn't search a single segment."""
+    segment = searcher.reader().segment()
+    return segment.segment_id() if segment is not None else None
+
+def _per_segment(cache, key, leaves, build):
+    """Returns ``build(subsearcher)`` for each of the leaf searchers. The
+    values are cached in ``cache[key]`` by the segment ids, as segments never
+    change once written (only their documents may get deleted). Values of
+    segments no longer searched are dropped.
+    """
+    cached = cache.get(key, {})
+    fresh = {}
+    values = []
+    for subsearcher, _ in leaves:
+        segid = _segment_id(subsearcher)
+        value = cached.get(segid) if segid is not None else None
+        if value is None:
+            value = build(subsearcher)
+        if segid is not None:
+            fresh[segid] = value
+        values.append(value)
+    cache[key] = fresh
+    return values
+
+class _DeadlineReader(object):
+    """Index reader listing the terms of the wrapped reader that raises
+    :class:`whoosh.searching.TimeLimit` once ``time.time()`` passes the
+    ``deadline``."""
+
+    def __init__(self, reader, deadline):
+        self._reader = reader
+        self._deadline = deadline
+
+    def __getattr__(self, name):
+        return getattr(self._reader, name)
+
+    def _bounded(self, terms):
+        from whoosh.searching import TimeLimit
+
+        for i, term in enumerate(terms):
+            # checking the time is relatively expensive
+            if not i % 256 and time.time() > self._deadline:
+                raise TimeLimit
+            yield term
+
+    def lexicon(self, fieldname):
+        """Yields the terms of the field until the deadline."""
+        return self._bounded(self._reader.lexicon(fieldname))
+
+    def expand_prefix(self, fieldname, prefix):
+        """Yields the terms of the field starting with ``prefix`` until the
+        deadline."""
+        return self._bounded(self._reader.expand_prefix(fieldname, prefix))
+
+def _bound_expansion(query, deadline):
+    """Returns the query with its wildcard, prefix and regex queries
+    expanded to the matching terms only until the ``deadline``, see
+    `_DeadlineReader`."""
+    import copy
+    from whoosh.query import MultiTerm
+
+    def bound(q):
+        if not isinstance(q, MultiTerm):
+            return q
+        q = copy.copy(q)
+        expand = q._btexts
+        q._btexts = lambda reader: expand(_DeadlineReader(reader, deadline))
+        return q
+
+    return query.accept(bound)
+
+def _stored_values(reader, fieldname):
+    """Returns a sequence mapping document numbers of the reader to the
+    stored values of the field; an array for integer values."""
+    import array
+
+    values = [None] * reader.doc_count_all()
+    for docnum, fields in reader.iter_docs():
+        values[docnum] = fields.get(fieldname)
+    try:
+        # deleted documents (None) are never looked up
+        return array.array('q', [0 if v is None else v for v in values])
+    except (TypeError, OverflowError):
+        return values
+
+def _index_writer(index, config):
+    """Returns a writer of the index with the options of
+    ``WHOOSHEE_WRITER_OPTIONS``."""
+    options = {'timeout': config['writer_timeout']}
+    options.update(config['writer_options'])
+    return index.writer(**options)
+
+@contextmanager
+def _write_lock(storage, config, indexname=None):
+    """Holds the write lock of the index in ``storage``, so that no writer
+    commits meanwhile. Raises :class:`whoosh.index.LockError` if it isn't
+    released within ``WHOOSHEE_WRITER_TIMEOUT``."""
+    import whoosh.index
+    from whoosh.util.filelock import try_for
+
+    lock = storage.lock('{0}_WRITELOCK'.format(indexname or whoosh.index._DEF_INDEX_NAME))
+    if not try_for(lock.acquire, timeout=config['writer_timeout'], delay=0.1):
+        raise whoosh.index.LockError
+    try:
+        yield
+    finally:
+        lock.release()
+
+def _indexing_errors():
+    """Returns the exceptions of failed index writes that are worth trying
+    again later, as the index or the database was locked or unavailable."""
+    import whoosh.index
+    from whoosh.filedb.filestore import StorageError
+
+    return (OSError, sqlalchemy.exc.SQLAlchemyError, whoosh.index.IndexError,
+            whoosh.index.LockError, StorageError)
+
+def _copy_index_file(storage, name, directory):
+    # copied under a name whoosh ignores and renamed, so it appears complete
+    temp_path = os.path.join(directory, '.{0}.tmp'.format(name))
+    source = storage.open_file(name)
+    try:
+        with open(temp_path, 'wb') as f:
+            shutil.copyfileobj(source, f)
+    finally:
+        source.close()
+    os.rename(temp_path, os.path.join(directory, name))
+
+def _link_index_file(storage, name, directory):
+    from whoosh.filedb.filestore import FileStorage
+
+    if isinstance(storage, FileStorage):
+        try:
+            os.link(os.path.join(storage.folder, name), os.path.join(directory, name))
+            return
+        except (IOError, OSError) as err:
+            # e.g. another file system, copy it instead
+            if err.errno == errno.ENOENT:
+                raise
+    _copy_index_file(storage, name, directory)
+
+def _publish_generation(storage, indexname, directory, link=False):
+    """Copies (or hardlinks with ``link``) the latest generation of the
+    index in ``storage`` into ``directory``, skipping the segment files that
+    are already there, and removes the files of older generations. Returns
+    the table of contents of the new generation, or ``None`` if ``directory``
+    already has it."""
+    from whoosh.filedb.filestore import FileStorage
+    from whoosh.index import TOC, clean_files
+
+    transfer = _link_index_file if link else _copy_index_file
+    _assure_dirs_exists(directory)
+    toc = None
+    while True:
+        previous = toc
+        try:
+            toc = TOC.read(storage, indexname)
+            toc_name = TOC._filename(indexname, toc.generation)
+            if os.path.exists(os.path.join(directory, toc_name)):
+                return None
+            for segment in toc.segments:
+                for name in segment.list_files(storage):
+                    # segment files never change once written
+                    if not os.path.exists(os.path.join(directory, name)):
+                        transfer(storage, name, directory)
+            # the new generation becomes visible with its table of contents
+            transfer(storage, toc_name, directory)
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT or \
+                    (previous is not None and previous.generation == toc.generation):
+                raise
+            # a writer has replaced the generation meanwhile, publish the new one
+            continue
+        clean_files(FileStorage(directory), indexname, toc.generation, toc.segments)
+        return toc
+
+def _snapshot_files(path, subdir):
+    """Returns the names of the files of the index ``subdir`` in the
+    snapshot in ``path`` taken by `Whooshee.snapshot`, or ``None`` if the
+    snapshot doesn't have the index."""
+    try:
+        with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (IOError, OSError) as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return None
+    if subdir not in manifest['indexes']:
+        return None
+    return manifest['indexes'][subdir]['files']
+
+def _ram_storage():
+    """Returns a new memory storage. whoosh's memory storages spill the
+    segments being written to ``<tempdir>/<indexname>.tmp``, which is shared
+    by all the memory indexes of the host, so writers of different indexes
+    delete each other's files; every storage gets its own directory instead."""
+    from whoosh.filedb.filestore import FileStorage, RamStorage
+    from whoosh.util import random_name
+
+    storage = RamStorage()
+    prefix = 'whooshee-{0}-'.format(random_name())
+
+    def temp_storage(name=None):
+        name = name or '{0}.tmp'.format(random_name())
+        return FileStorage(os.path.join(tempfile.gettempdir(), prefix + name)).create()
+
+    storage.temp_storage = temp_storage
+    return storage
+
+def _load_into_memory(directory, names):
+    storage = _ram_storage()
+    for name in names:
+        # whoosh reads memory files through BytesIO, which shares bytes without copying
+        with open(os.path.join(directory, name), 'rb') as f:
+            storage.files[name] = f.read()
+    return storage.open_index()
+
+class _DatabaseLock(object):
+    """Lock of an index stored in the database, held by the row of
+    ``whooshee_locks`` named after it. A lock that wasn't acquired or renewed
+    for more than ``expiry`` seconds is considered left by a crashed process
+    and taken over. While held, the lock is kept in the ``held`` list."""
+
+    def __init__(self, engine, index_name, name, expiry=600, held=None):
+        self.engine = engine
+        self.index_name = index_name
+        self.name = name
+        self.expiry = expiry
+        self.held = held if held is not None else []
+        self.owner = None
+        self.locked = False
+        # the thread holding the lock, see `DatabaseStorage._renew_lock`
+        self.thread = None
+
+    def _where(self):
+        return sqlalchemy.and_(locks_table.c.index_name == self.index_name,
+                               locks_table.c.name == self.name)
+
+    def acquire(self, blocking=False):
+        """Acquires the lock, waiting for it if ``blocking``. Returns
+        ``False`` if it's held by someone else."""
+        while True:
+            acquired = datetime.datetime.utcnow()
+            owner = uuid.uuid4().hex
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(locks_table.insert().values(
+                        index_name=self.index_name, name=self.name, acquired=acquired, owner=owner))
+            except sqlalchemy.exc.IntegrityError:
+                # only one of the processes waiting for an expired lock removes it
+                with self.engine.begin() as connection:
+                    expired = connection.execute(locks_table.delete().where(sqlalchemy.and_(
+                        self._where(),
+                        locks_table.c.acquired < acquired - datetime.timedelta(seconds=self.expiry),
+                    ))).rowcount
+                if expired:
+                    continue
+                if not blocking:
+                    return False
+                time.sleep(0.05)
+                continue
+            self.owner = owner
+            self.locked = True
+            self.thread = threading.current_thread()
+            self.held.append(self)
+            return True
+
+    def renew(self):
+        """Moves the expiry of the held lock forward. Returns ``False`` if
+        it has been taken over already."""
+        with self.engine.begin() as connection:
+            return connection.execute(locks_table.update().where(sqlalchemy.and_(
+                self._where(), locks_table.c.owner == self.owner,
+            )).values(acquired=datetime.datetime.utcnow())).rowcount > 0
+
+    def release(self):
+        """Releases the lock unless it was taken over meanwhile."""
+        # the lock may have expired and been taken over meanwhile
+        with self.engine.begin() as connection:
+            connection.execute(locks_table.delete().where(sqlalchemy.and_(
+                self._where(), locks_table.c.owner == self.owner)))
+        self.locked = False
+        if self in self.held:
+            self.held.remove(self)
+
+def _database_storage(engine, index_name, cache_dir, supports_mmap=True, lock_expiry=600):
+    """Returns a whoosh storage keeping the files of the index ``index_name``
+    in the ``whooshee_files`` table. Index files never change once written,
+    so the files read or written by the process are cached in ``cache_dir``
+    and read from there (memory-mapped with ``supports_mmap``). Locks not
+    renewed for more than ``lock_expiry`` seconds are taken over; the lock
+    of the writer is renewed with every file written, and a writer whose lock
+    was taken over fails instead of committing."""
+    from io import BytesIO
+    from whoosh.filedb.filestore import FileStorage, Storage
+    from whoosh.filedb.structfile import StructFile
+    from whoosh.util import random_name
+
+    c = files_table.c
+
+    class DatabaseStorage(Storage):
+        """Whoosh storage of the index files in ``whooshee_files``."""
+
+        def __init__(self):
+            self.engine = engine
+            self.index_name = index_name
+            self.cache_dir = cache_dir
+            self.supports_mmap = supports_mmap
+            self.lock_expiry = lock_expiry
+            # the held locks given out by `lock`, oldest first
+            self.locks = []
+
+        def __repr__(self):
+            return '{0}({1!r})'.format(type(self).__name__, self.index_name)
+
+        def _where(self, name=None):
+            clause = c.index_name == self.index_name
+            if name is not None:
+                clause = sqlalchemy.and_(clause, c.name == name)
+            return clause
+
+        def _select(self, column, name):
+            with self.engine.connect() as connection:
+                return connection.execute(
+                    sqlalchemy.select(column).where(self._where(name))).scalar()
+
+        def _cache_path(self, file_id, name):
+            # the id changes whenever a file of the same name is written again
+            return os.path.join(self.cache_dir, '{0}.{1}'.format(file_id, name))
+
+        def _cache(self, file_id, name, data):
+            _assure_dirs_exists(self.cache_dir)
+            temp_path = os.path.join(self.cache_dir, '.{0}.tmp'.format(random_name()))
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, self._cache_path(file_id, name))
+
+        def _prune_cache(self):
+            with self.engine.connect() as connection:
+                ids = set(str(file_id) for file_id in connection.execute(
+                    sqlalchemy.select(c.id).where(self._where())).scalars())
+            for cached in os.listdir(self.cache_dir):
+                if not cached.startswith('.') and cached.split('.', 1)[0] not in ids:
+                    try:
+                        os.remove(os.path.join(self.cache_dir, cached))
+                    except OSError:
+                        pass
+
+        def create(self):
+            outbox_metadata.create_all(self.engine, tables=[files_table, locks_table])
+            return self
+
+        def destroy(self, *args, **kwargs):
+            with self.engine.begin() as connection:
+                connection.execute(files_table.delete().where(self._where()))
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+        def _renew_lock(self):
+            from whoosh.index import LockError
+
+            # the last lock taken by the thread is the one of its writer
+            thread = threading.current_thread()
+            held = [lock for lock in self.locks if lock.thread is thread]
+            if held and not held[-1].renew():
+                raise LockError('The lock {0} of {1} was taken over'.format(
+                    held[-1].name, self.index_name))
+
+        def create_file(self, name, **kwargs):
+            def store(f):
+                # e.g. the table of contents isn't committed without the lock
+                self._renew_lock()
+                data = f.file.getvalue()
+                with self.engine.begin() as connection:
+                    connection.execute(files_table.delete().where(self._where(name)))
+                    file_id = connection.execute(files_table.insert().values(
+                        index_name=self.index_name, name=name, size=len(data),
+                        modified=time.time(), data=data)).inserted_primary_key[0]
+                self._cache(file_id, name, data)
+            return StructFile(BytesIO(), name=name, onclose=store)
+
+        def open_file(self, name, *args, **kwargs):
+            file_id = self._select(c.id, name)
+            if file_id is None:
+                raise IOError(errno.ENOENT, 'No such index file', name)
+            path = self._cache_path(file_id, name)
+            if not os.path.exists(path):
+                with self.engine.connect() as connection:
+                    data = connection.execute(
+                        sqlalchemy.select(c.data).where(c.id == file_id)).scalar()
+                if data is None:
+                    raise IOError(errno.ENOENT, 'No such index file', name)
+                self._cache(file_id, name, data)
+                # a new file was fetched, forget the ones that were removed
+                self._prune_cache()
+            return StructFile(open(path, 'rb'), name=name, **kwargs)
+
+        def list(self):
+            with self.engine.connect() as connection:
+                return list(connection.execute(
+                    sqlalchemy.select(c.name).where(self._where())).scalars())
+
+        def file_exists(self, name):
+            return self._select(c.id, name) is not None
+
+        def file_modified(self, name):
+            return self._select(c.modified, name)
+
+        def file_length(self, name):
+            return self._select(c.size, name)
+
+        def delete_file(self, name):
+            with self.engine.begin() as connection:
+                connection.execute(files_table.delete().where(self._where(name)))
+
+        def rename_file(self, frm, to, safe=False):
+            if safe and self.file_exists(to):
+                raise NameError('File {0!r} exists'.format(to))
+            file_id = self._select(c.id, frm)
+            with self.engine.begin() as connection:
+                connection.execute(files_table.delete().where(self._where(to)))
+                connection.execute(files_table.update().where(self._where(frm)).values(name=to))
+            if file_id is not None and os.path.exists(self._cache_path(file_id, frm)):
+                os.rename(self._cache_path(file_id, frm), self._cache_path(file_id, to))
+
+        def lock(self, name):
+            return _DatabaseLock(self.engine, self.index_name, name, self.lock_expiry,
+                                 held=self.locks)
+
+        def temp_storage(self, name=None):
+            # only a single writer of the index runs at a time, like in a file index
+            name = name or '{0}.tmp'.format(random_name())
+            return FileStorage(os.path.join(self.cache_dir, '.' + name)).create()
+
+    return DatabaseStorage()
+
+def _make_cli():
+    """Returns the group of the ``flask whooshee`` commands."""
+    import click
+    from flask.cli import AppGroup
+
+    cli = AppGroup('whooshee', help='Maintain the Flask-Whooshee indexes.')
+
+    @cli.command('drain')
+    @click.option('--batch-size', default=1000, show_default=True,
+                  help='Number of changes indexed at once.')
+    @click.option('--follow', is_flag=True, help='Keep waiting for new changes.')
+    @click.option('--interval', default=1.0, show_default=True,
+                  help='Seconds to wait for new changes with --follow.')
+    def drain(batch_size, follow, interval):
+        """Index the changes stored in the outbox table."""
+        whooshee = current_app.extensions['whooshee']['extension']
+        while True:
+            processed = whooshee.drain(batch_size=batch_size)
+            if processed:
+                click.echo('Indexed {0} changes.'.format(processed))
+            if not follow:
+                break
+            time.sleep(interval)
+
+    @cli.command('indexer')
+    @click.option('--socket', 'socket_path', help='Defaults to WHOOSHEE_INDEXER_SOCKET.')
+    @click.option('--batch-size', default=1000, show_default=True,
+                  help='Maximum number of changes committed at once.')
+    @click.option('--commit-interval', default=0.05, show_default=True,
+                  help='Seconds to wait for more changes before committing.')
+    def indexer(socket_path, batch_size, commit_interval):
+        """Run the indexer serving the application processes."""
+        config = current_app.extensions['whooshee']
+        socket_path = socket_path or config['indexer_socket']
+        if not socket_path:
+            raise click.UsageError('Set WHOOSHEE_INDEXER_SOCKET or pass --socket.')
+        indexer = Indexer(config['extension'], current_app._get_current_object(),
+                          socket_path=socket_path, batch_size=batch_size,
+                          commit_interval=commit_interval)
+        click.echo('Indexing changes sent to {0}'.format(socket_path))
+        try:
+            indexer.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            indexer.shutdown()
+
+    @cli.command('publish')
+    @click.argument('path')
+    @click.option('--follow', is_flag=True, help='Keep publishing new generations.')
+    @click.option('--interval', default=1.0, show_default=True,
+                  help='Seconds between publishing with --follow.')
+    def publish(path, follow, interval):
+        """Copy the indexes to PATH for read-only replicas."""
+        whooshee = current_app.extensions['whooshee']['extension']
+        while True:
+            published = whooshee.publish(path)
+            if published:
+                click.echo('Published {0} indexes.'.format(published))
+            if not follow:
+                break
+            time.sleep(interval)
+
+    @cli.command('snapshot')
+    @click.argument('path')
+    def snapshot(path):
+        """Capture the indexes in the new directory PATH."""
+        current_app.extensions['whooshee']['extension'].snapshot(path)
+        click.echo('Snapshot taken in {0}'.format(path))
+
+    @cli.command('restore')
+    @click.argument('path')
+    def restore(path):
+        """Replace the indexes by the snapshot in PATH."""
+        current_app.extensions['whooshee']['extension'].restore(path)
+        click.echo('Restored the snapshot in {0}'.format(path))
+
+    @cli.command('broadcaster')
+    @click.option('--socket', 'socket_path', help='Defaults to WHOOSHEE_BROADCAST_SOCKET.')
+    def broadcaster(socket_path):
+        """Run the hub syncing the memory indexes of the processes."""
+        socket_path = socket_path or current_app.config.get('WHOOSHEE_BROADCAST_SOCKET')
+        if not socket_path:
+            raise click.UsageError('Set WHOOSHEE_BROADCAST_SOCKET or pass --socket.')
+        broadcaster = Broadcaster(socket_path)
+        click.echo('Broadcasting changes sent to {0}'.format(socket_path))
+        try:
+            broadcaster.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            broadcaster.shutdown()
+
+    @cli.command('replay-journal')
+    def replay_journal():
+        """Index the changes left in the journals of ended processes."""
+        whooshee = current_app.extensions['whooshee']['extension']
+        click.echo('Replayed {0} changes.'.format(whooshee.replay_journal()))
+
+    return cli
+
+def _assure_own_process(config):
+    """Forgets indexes and searchers inherited from the parent process after
+    a fork. Their open files are shared with the parent (including the file
+    offsets), so they are closed and reopened on first use. Memory storage
+    indexes and their searchers don't hold any files, so they are kept and
+    whatever was warmed up before forking stays shared copy-on-write.
+    """
+    pid = os.getpid()
+    if config['pid'] == pid:
+        return
+    from whoosh.filedb.filestore import RamStorage
+    # the lock could have been held by another thread of the parent when forking
+    config['searchers_lock'] = threading.Lock()
+    indexes = {}
+    for wh, index in list(config['whoosheers_indexes'].items()):
+        if isinstance(index.storage, RamStorage):
+            indexes[wh] = index
+    searchers = {}
+    for wh, pool in list(config['whoosheers_searchers'].items()):
+        if wh in indexes:
+            searchers[wh] = pool
+        else:
+            for searcher in pool:
+                searcher.close()
+    config['whoosheers_indexes'] = indexes
+    config['whoosheers_searchers'] = searchers
+    config['partitions_lru'] = OrderedDict(
+        (key, True) for key in config['partitions_lru'] if key in indexes)
+    config['pid'] = pid
+
+def _load_old_value(target, value, oldvalue, initiator):
+    # listener of the partition attributes, only there for `active_history`
+    pass
+
+_SNAPSHOT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def _partition_name(wh, partition):
+    """Returns the partition of the whoosheer's index as text, checking
+    it's given exactly for the whoosheers with ``partition_by``."""
+    if not getattr(wh, 'partition_by', None):
+        if partition is not None:
+            raise ValueError('{0} is not partitioned'.format(wh.__name__))
+        return None
+    if partition is None:
+        raise ValueError('{0} is partitioned by {1}, pass the partition'.format(
+            wh.__name__, wh.partition_by))
+    return _to_text(partition)
+
+def _partition_of(wh, instance):
+    """Returns the partition of the whoosheer's index the instance belongs
+    to; instances without the ``partition_by`` value go to the ``''`` one."""
+    value = getattr(instance, wh.partition_by)
+    return u'' if value is None else _to_text(value)
+
+# directory of the ``''`` partition, quoting never produces it
+_EMPTY_PARTITION_DIR = '%empty'
+
+def _partition_dir(partition):
+    """Returns the name of the partition's index directory: the partition
+    quoted to a file name, which never starts with a dot."""
+    if not partition:
+        return _EMPTY_PARTITION_DIR
+    return quote(partition.encode('utf-8'), safe='').replace('.', '%2E')
+
+def _dir_partition(name):
+    """Returns the partition of the index directory, see `_partition_dir`."""
+    return u'' if name == _EMPTY_PARTITION_DIR else unquote(name)
+
+def _index_key(wh, partition):
+    # key of the index in `whoosheers_indexes` and `whoosheers_searchers`
+    return wh if partition is None else (wh, partition)
+
+# guards opening the journal and the broadcast subscription of the process
+_process_lock = threading.Lock()
+
+def _read_journal(f):
+    changes = []
+    for line in f.read().splitlines():
+        try:
+            changes.append(tuple(json.loads(line.decode('utf-8'))))
+        except ValueError:
+            # the last line may be cut short by a crash
+            continue
+    return changes
+
+class _Journal(object):
+    """Append-only file of the changes a process hasn't indexed yet, one
+    ``(model name, primary key, operation)`` JSON list per line. Entries are
+    written as the changes are flushed, synced to disk once per flush and the
+    file is truncated whenever all of them are indexed. The file stays locked
+    while the process lives, so journals left by dead processes can be told
+    apart and replayed, see :meth:`Whooshee.replay_journal`.
+    """
+
+    def __init__(self, directory):
+        import fcntl
+        _assure_dirs_exists(directory)
+        self.directory = directory
+        self.pid = os.getpid()
+        self.path = os.path.join(directory, '{0}.journal'.format(self.pid))
+        self.lock = threading.Lock()
+        # unbuffered, so a fork can't write the same entries twice; it stays open
+        # (and locked) as long as the process lives
+        self.file = open(self.path, 'a+b', buffering=0)  # pylint: disable=consider-using-with
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # changes that failed to be indexed, retried with the next ones; a dead
+        # process with the same pid may have left some
+        self.file.seek(0)
+        self.failed = _read_journal(self.file)
+        # journaled changes not indexed yet, the file is truncated when there are none
+        self.pending = len(self.failed)
+        self.dirty = False
+        # whether the journals of dead processes were replayed
+        self.replayed = False
+
+    def append(self, key):
+        """Journals the ``(model name, primary key, operation)`` change."""
+        with self.lock:
+            self.file.write((json.dumps(key) + '\n').encode('utf-8'))
+            self.pending += 1
+            self.dirty = True
+
+    def sync(self):
+        """Writes the entries appended since the last sync to disk."""
+        with self.lock:
+            if self.dirty:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.dirty = False
+
+    def take_failed(self):
+        """Returns the changes that failed to be indexed and forgets them;
+        they are journaled until :meth:`done` is called with them."""
+        with self.lock:
+            failed, self.failed = self.failed, []
+            return failed
+
+    def done(self, count, failed=()):
+        """Marks ``count`` entries as indexed or discarded, except the
+        ``failed`` changes, which are kept for the next attempt."""
+        with self.lock:
+            self.failed.extend(failed)
+            self.pending -= count - len(failed)
+            if self.pending <= 0:
+                self.pending = 0
+                self.file.truncate(0)
+                self.dirty = False
+
+    def orphans(self):
+        """Yields ``(path, changes)`` of the journals of dead processes while
+        holding their locks; the journal is removed after resuming."""
+        import fcntl
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.journal') or path == self.path:
+                continue
+            with open(path, 'rb') as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    # the process is still running
+                    continue
+                yield path, _read_journal(f)
+                os.remove(path)
+
 class WhoosheeQuery(Query):
     """An override for SQLAlchemy query used to do fulltext search."""
 
-    def whooshee_search(self, search_string, group=whoosh.qparser.OrGroup, whoosheer=None,
-                        match_substrings=True, limit=None, order_by_relevance=10):
-        """Do a fulltext search on the query.
-        Returns a query filtered with results of the fulltext search.
+    # whether the fulltext search of `whooshee_search` ran out of time
+    whooshee_truncated = False
+
+    def _find_whoosheer(self):
+        """Returns the whoosheer of the entities queried (and joined) by this
+        query."""
+        from sqlalchemy.inspection import inspect
+        from sqlalchemy.orm.mapper import Mapper
+        from sqlalchemy.orm.util import AliasedClass, AliasedInsp
+        from sqlalchemy.sql import visitors
+        from sqlalchemy.sql.annotation import AnnotatedTable, AnnotatedAlias
+
+        ### inspiration taken from flask-WhooshAlchemy
+        # find out all entities in join
+        entities = set()
+        # directly queried entities
+        for cd in self.column_descriptions:
+            entities.add(cd['type'])
+        # joined entities
+
+        if not hasattr(self, "_join_entities"):
+            # SQLAlchemy 1.4+
+            for node in visitors.iterate(self.statement, {}):
+                if isinstance(node, AnnotatedTable) or isinstance(node, AnnotatedAlias):
+                    entities.add(node.entity_namespace)
+        elif self._join_entities and isinstance(self._join_entities[0], Mapper):
+            # SQLAlchemy >= 0.8.0
+            entities.update(set([x.entity for x in self._join_entities]))
+        else:
+            # SQLAlchemy < 0.8.0
+            entities.update(set(self._join_entities))
+        # make sure we can work with aliased entities
+        unaliased = set()
+        for entity in entities:
+            if isinstance(entity, (AliasedClass, AliasedInsp)):
+                unaliased.add(inspect(entity).mapper.class_)
+            else:
+                unaliased.add(entity)
 
-        :param search_string: The string to search for.
-        :param group: The whoosh group to use for searching.
-                      Defaults to :class:`whoosh.qparser.OrGroup` which
-                      searches for all words in all columns.
-        :param match_substrings: ``True`` if you want to match substrings,
-                                 ``False`` otherwise
-        :param limit: The number of the top records to be returned.
-                      Defaults to ``None`` and returns all records.
+        return next(w for w in _get_config(self)['whoosheers']
+                    if set(w.models) == unaliased)
+
+    def _whooshee_ids(self, search_string, whoosheer, pushdown_filters, **kwargs):
+        """Searches the whoosheer (by default the one of the queried entities)
+        and returns the model attribute of its unique field along with the
+        found values of it. The keyword arguments are passed to
+        :meth:`AbstractWhoosheer.search`.
         """
         if not whoosheer:
-            ### inspiration taken from flask-WhooshAlchemy
-            # find out all entities in join
-            entities = set()
-            # directly queried entities
-            for cd in self.column_descriptions:
-                entities.add(cd['type'])
-            # joined entities
-
-            if not hasattr(self, "_join_entities"):
-                # SQLAlchemy 1.4+
-                for node in visitors.iterate(self.statement, {}):
-                    if isinstance(node, AnnotatedTable) or isinstance(node, AnnotatedAlias):
-                        entities.add(node.entity_namespace)
-            elif self._join_entities and isinstance(self._join_entities[0], Mapper):
-                # SQLAlchemy >= 0.8.0
-                entities.update(set([x.entity for x in self._join_entities]))
-            else:
-                # SQLAlchemy < 0.8.0
-                entities.update(set(self._join_entities))
-            # make sure we can work with aliased entities
-            unaliased = set()
-            for entity in entities:
-                if isinstance(entity, (AliasedClass, AliasedInsp)):
-                    unaliased.add(inspect(entity).mapper.class_)
-                else:
-                    unaliased.add(entity)
+            whoosheer = self._find_whoosheer()
 
-            whoosheer = next(w for w in _get_config(self)['whoosheers']
-                             if set(w.models) == unaliased)
+        uniq = _unique_field(whoosheer)
 
-        # TODO what if unique field doesn't exist or there are multiple?
-        for fname, field in list(whoosheer.schema._fields.items()):
-            if field.unique:
-                uniq = fname
+        search_filter = None
+        if pushdown_filters:
+            search_filter = _pushdown_filter(self.whereclause, whoosheer)
 
         # TODO: use something more general than id
         res = whoosheer.search(search_string=search_string,
                                values_of=uniq,
-                               group=group,
-                               match_substrings=match_substrings,
-                               limit=limit)
-        if not res:
-            return self.filter(text('null'))
+                               search_filter=search_filter,
+                               **kwargs)
 
         # transform unique field name into model attribute field
         attr = None
@@ -125,7 +1044,67 @@ class WhoosheeQuery(Query):
                 if m.__name__.lower() == uniq.split('_')[0]:
                     attr = getattr(m, uniq.split('_')[1])
 
+        return attr, res
+
+    def whooshee_search(self, search_string, group=None, whoosheer=None,
+                        match_substrings=True, limit=None, order_by_relevance=10,
+                        sort_by=None, reverse=False, pushdown_filters=True, filters=(),
+                        timeout=None, partition=None):
+        """Do a fulltext search on the query.
+        Returns a query filtered with results of the fulltext search.
+
+        :param search_string: The string to search for.
+        :param group: The whoosh group to use for searching.
+                      Defaults to :class:`whoosh.qparser.OrGroup` which
+                      searches for all words in all columns.
+        :param match_substrings: ``True`` if you want to match substrings,
+                                 ``False`` otherwise
+        :param limit: The number of the top records to be returned.
+                      Defaults to ``None`` and returns all records.
+        :param order_by_relevance: The number of the top records to be ordered
+                                   by relevance, all of them if negative,
+                                   none if ``0``.
+        :param sort_by: Name (or list of names) of sortable whoosheer fields
+                        to order the search results by instead of relevance.
+                        All the results are ordered by them, unless
+                        ``order_by_relevance`` is ``0``.
+        :param reverse: ``True`` to reverse the ``sort_by`` order.
+        :param pushdown_filters: ``True`` to apply the simple conditions of
+                                 the query on indexed columns already in the
+                                 index, so that ``limit`` counts only the
+                                 records matching them.
+        :param filters: Names of the whoosheer's cached filters the records
+                        must match.
+        :param timeout: The number of seconds after which the fulltext search
+                        is stopped, see :meth:`AbstractWhoosheer.search`. The
+                        ``whooshee_truncated`` attribute of the returned query
+                        is ``True`` if it was.
+        :param partition: The partition to search if the whoosheer has
+                          ``partition_by``. Only the partition's index is
+                          opened, the query isn't filtered by it.
+        """
+        # the relevance decides which records are the top ones, even if they won't be ordered
+        scored = order_by_relevance != 0 or limit is not None
+        attr, res = self._whooshee_ids(search_string, whoosheer, pushdown_filters,
+                                       group=group,
+                                       match_substrings=match_substrings,
+                                       limit=limit,
+                                       sort_by=sort_by,
+                                       reverse=reverse,
+                                       filters=filters,
+                                       scored=scored,
+                                       timeout=timeout,
+                                       partition=partition)
+        if not res:
+            search_query = self.filter(text('null'))
+            search_query.whooshee_truncated = getattr(res, 'truncated', False)
+            return search_query
+        if sort_by is not None and order_by_relevance > 0:
+            # a partial order makes no sense for explicitly sorted results
+            order_by_relevance = -1
+
         search_query = self.filter(attr.in_(res))
+        search_query.whooshee_truncated = getattr(res, 'truncated', False)
 
         if order_by_relevance < 0: # we want all returned rows ordered
             search_query = search_query.order_by(sqlalchemy.sql.expression.case(
@@ -141,6 +1120,104 @@ class WhoosheeQuery(Query):
 
         return search_query
 
+    def iter_search(self, search_string, batch_size=100, group=None, whoosheer=None,
+                    match_substrings=True, limit=None, sort_by=None, reverse=False,
+                    pushdown_filters=True, filters=(), timeout=None, partition=None):
+        """Yields the results of the query filtered by the fulltext search in
+        the order of relevance (or ``sort_by``), e.g. for exporting all of
+        them. Unlike :meth:`whooshee_search`, the records are loaded from the
+        database in batches of ``batch_size`` records, so only the found IDs
+        and a single batch are kept in memory.
+
+        The other arguments are the same as of :meth:`whooshee_search`.
+        """
+        attr, res = self._whooshee_ids(search_string, whoosheer, pushdown_filters,
+                                       group=group,
+                                       match_substrings=match_substrings,
+                                       limit=limit,
+                                       sort_by=sort_by,
+                                       reverse=reverse,
+                                       filters=filters,
+                                       timeout=timeout,
+                                       partition=partition)
+        for start in range(0, len(res), batch_size):
+            batch = res[start:start + batch_size]
+            position = dict((uniq_val, index) for index, uniq_val in enumerate(batch))
+            # the unique value is selected as the last column to order the batch by it
+            rows = self.filter(attr.in_(batch)).add_columns(attr).all()
+            rows.sort(key=lambda row: position[row[-1]])
+            for row in rows:
+                yield row[0] if len(row) == 2 else tuple(row[:-1])
+
+    def whooshee_count(self, search_string, group=None, whoosheer=None,
+                       match_substrings=True, pushdown_filters=True, filters=(),
+                       estimate=False, partition=None):
+        """Returns the number of records matching the fulltext search,
+        counted by the index without querying the database if all the
+        conditions of the query can be pushed down to the index (see
+        ``pushdown_filters`` of :meth:`whooshee_search`). Otherwise, or if
+        the query has joins, ``distinct``, ``group_by`` and the like, the
+        records are counted by the database.
+
+        :param estimate: ``True`` to return a cheap estimate instead, see
+                         :meth:`AbstractWhoosheer.count`. The conditions
+                         that can't be pushed down are ignored by it.
+
+        The other arguments are the same as of :meth:`whooshee_search`.
+        """
+        whoosheer = whoosheer or self._find_whoosheer()
+        search_filter, complete = self._index_filter(whoosheer, pushdown_filters)
+        if not complete and not estimate:
+            return self.whooshee_search(search_string, group=group, whoosheer=whoosheer,
+                                        match_substrings=match_substrings, order_by_relevance=0,
+                                        pushdown_filters=pushdown_filters, filters=filters,
+                                        partition=partition).count()
+        return whoosheer.count(search_string, group=group, match_substrings=match_substrings,
+                               search_filter=search_filter, filters=filters,
+                               estimate=estimate, partition=partition)
+
+    def whooshee_exists(self, search_string, group=None, whoosheer=None,
+                        match_substrings=True, pushdown_filters=True, filters=(),
+                        partition=None):
+        """Returns ``True`` if any record matches the fulltext search. Like
+        :meth:`whooshee_count`, it's answered by the index unless the query
+        has conditions that can't be pushed down to it.
+        """
+        whoosheer = whoosheer or self._find_whoosheer()
+        search_filter, complete = self._index_filter(whoosheer, pushdown_filters)
+        if not complete:
+            return self.whooshee_search(search_string, group=group, whoosheer=whoosheer,
+                                        match_substrings=match_substrings, order_by_relevance=0,
+                                        pushdown_filters=pushdown_filters, filters=filters,
+                                        partition=partition).first() is not None
+        return whoosheer.exists(search_string, group=group, match_substrings=match_substrings,
+                                search_filter=search_filter, filters=filters,
+                                partition=partition)
+
+    def _index_filter(self, whoosheer, pushdown_filters):
+        """Returns the conditions of the query as a whoosh query and whether
+        the index can evaluate the whole query by it. Joins, selecting from
+        other tables, ``distinct``, ``group_by``, ``having``, ``limit`` and
+        ``offset`` can only be evaluated by the database."""
+        if any(getattr(self, attr, None) for attr in ('_join_entities', '_setup_joins', '_from_obj',
+                                                      '_distinct', '_distinct_on',
+                                                      '_group_by_clauses', '_having_criteria')) or \
+                getattr(self, '_limit_clause', None) is not None or \
+                getattr(self, '_offset_clause', None) is not None:
+            return None, False
+        if not pushdown_filters:
+            return None, self.whereclause is None
+        search_filter, rest = _pushdown_filter(self.whereclause, whoosheer, with_rest=True)
+        return search_filter, not rest
+
+class SearchValues(list):
+    """A list of values of the found records returned by
+    :meth:`AbstractWhoosheer.search`. ``truncated`` is ``True`` if the
+    search ran out of time and only the records found so far are included.
+    """
+
+    truncated = False
+
 class AbstractWhoosheer(object):
     """A superclass for all whoosheers.
 
@@ -152,9 +1229,18 @@ class AbstractWhoosheer(object):
     """
 
     auto_update = True
+    # names of the schema fields searched by `search`; all fields if None
+    search_fields = None
+    # named whoosh queries that `search` can be restricted by, see `filters`
+    cached_filters = {}
+    # name of the attribute of the models splitting the index into a separate
+    # index per value under `index_subdir`; searches pass `partition`
+    partition_by = None
 
     @classmethod
-    def search(cls, search_string, values_of='', group=whoosh.qparser.OrGroup, match_substrings=True, limit=None):
+    def search(cls, search_string, values_of='', group=None, match_substrings=True, limit=None,
+               sort_by=None, reverse=False, search_filter=None, filters=(), scored=True,
+               timeout=None, partition=None):
         """Searches the fields for given search_string.
         Returns the found records if 'values_of' is left empty,
         else the values of the given columns.
@@ -170,16 +1256,313 @@ class AbstractWhoosheer(object):
                                  ``False`` otherwise.
         :param limit: The number of the top records to be returned.
                       Defaults to ``None`` and returns all records.
+        :param sort_by: Name (or list of names) of fields to order the records
+                        by instead of relevance. Sorting is fastest on fields
+                        created with ``sortable=True``.
+        :param reverse: ``True`` to reverse the ``sort_by`` order.
+        :param search_filter: A whoosh query (or a set of document numbers)
+                              the records must also match, see
+                              :meth:`whoosh.searching.Searcher.search`.
+        :param filters: Names of ``cached_filters`` the records must match.
+                        The matching documents are computed once per index
+                        segment and reused by the following searches.
+        :param scored: ``False`` if the order of the records doesn't matter.
+                       The matching documents are then neither scored nor
+                       ranked and with ``values_of``, the values are read
+                       straight by their document numbers. Ignored with
+                       ``sort_by``.
+        :param timeout: The number of seconds after which the search is
+                        stopped and the records found so far are returned.
+                        Defaults to ``WHOOSHEE_SEARCH_TIMEOUT``. The
+                        ``truncated`` attribute of the returned results (or
+                        list of values) tells whether the search was stopped.
+        :param partition: The partition to search if the whoosheer has
+                          ``partition_by``; only its index is opened.
         """
-        index = Whooshee.get_or_create_index(_get_app(cls), cls)
-        prepped_string = cls.prep_search_string(search_string, match_substrings)
-        with index.searcher() as searcher:
-            parser = whoosh.qparser.MultifieldParser(cls.schema.names(), index.schema, group=group)
-            query = parser.parse(prepped_string)
-            results = searcher.search(query, limit=limit)
-            if values_of:
-                return [x[values_of] for x in results]
+        app = _get_app(cls)
+        searcher = Whooshee.get_searcher(app, cls, partition)
+        release = True
+        try:
+            results = cls._search(searcher, search_string, values_of, group, match_substrings,
+                                  limit, sort_by, reverse, search_filter, filters, scored,
+                                  timeout, partition)
+            if not values_of:
+                # the returned results keep using the searcher, so it can't go back to the pool
+                release = False
             return results
+        finally:
+            if release:
+                Whooshee.release_searcher(app, cls, searcher, partition)
+
+    @classmethod
+    def _search(cls, searcher, search_string, values_of='', group=None, match_substrings=True,
+                limit=None, sort_by=None, reverse=False, search_filter=None, filters=(),
+                scored=True, timeout=None, partition=None):
+        """Does the work of :meth:`search` with the given searcher (of the
+        given partition)."""
+        import itertools
+        import whoosh.collectors
+        from whoosh.searching import TimeLimit
+
+        app = _get_app(cls)
+        config = _get_config(cls)
+        if timeout is None:
+            timeout = config['search_timeout']
+        truncated = False
+        deadline = time.time() + timeout if timeout else None
+        try:
+            query = cls._parse(searcher, search_string, group, match_substrings)
+            if deadline is not None:
+                # expanding wildcards over big term dictionaries takes time as well
+                query = _bound_expansion(query, deadline)
+            if values_of and not scored and not sort_by:
+                allow = cls._combine_filters(app, searcher, search_filter, filters, as_docs=True,
+                                             partition=partition)
+                docnums = []
+                try:
+                    docnums.extend(itertools.islice(
+                        cls._matching_docs(searcher, query, allow, deadline), limit))
+                except TimeLimit:
+                    truncated = True
+            else:
+                search_filter = cls._combine_filters(app, searcher, search_filter, filters,
+                                                     partition=partition)
+                collector = searcher.collector(limit=limit, sortedby=sort_by, reverse=reverse,
+                                               filter=search_filter, scored=scored)
+                if timeout:
+                    # alarm signals can't be used outside of the main thread
+                    collector = whoosh.collectors.TimeLimitCollector(collector, timeout,
+                                                                     use_alarm=False)
+                try:
+                    searcher.search_with_collector(query, collector)
+                except TimeLimit:
+                    truncated = True
+                results = collector.results()
+                results.truncated = truncated
+                if not values_of:
+                    return results
+                docnums = [docnum for docnum, score in results.items()]
+            values = SearchValues(cls._values_of(searcher, values_of, docnums, partition))
+            values.truncated = truncated
+            return values
+        finally:
+            if truncated:
+                with config['searchers_lock']:
+                    config['search_timeouts'] += 1
+
+    @classmethod
+    def _values_of(cls, searcher, fieldname, docnums, partition=None):
+        """Returns the stored values of the field of the given documents.
+
+        The values are gathered from arrays mapping the document numbers of
+        each segment to the values, which are built on first use and cached
+        until the segment is merged away.
+        """
+        import bisect
+
+        leaves = searcher.leaf_searchers()
+        columns = _per_segment(_get_config(cls)['segments_cache'],
+                               (cls, _partition_name(cls, partition), 'values', fieldname), leaves,
+                               lambda sub: _stored_values(sub.reader(), fieldname))
+        if len(columns) == 1:
+            return list(map(columns[0].__getitem__, docnums))
+        offsets = [offset for sub, offset in leaves]
+        values = []
+        for docnum in docnums:
+            i = bisect.bisect_right(offsets, docnum) - 1
+            values.append(columns[i][docnum - offsets[i]])
+        return values
+
+    @classmethod
+    def count(cls, search_string, group=None, match_substrings=True, search_filter=None,
+              filters=(), estimate=False, partition=None):
+        """Returns the number of records matching the search string. The
+        matches are only counted, they are neither scored nor loaded.
+
+        :param search_string: The string to search for.
+        :param group: The whoosh group to use for searching.
+        :param match_substrings: ``True`` if you want to match substrings,
+                                 ``False`` otherwise.
+        :param search_filter: A whoosh query (or a set of document numbers)
+                              the records must also match.
+        :param filters: Names of ``cached_filters`` the records must match.
+        :param estimate: ``True`` to return a cheap estimate computed from
+                         the numbers of documents containing the searched
+                         terms instead. Ignored with ``filters``.
+        :param partition: The partition to search if the whoosheer has
+                          ``partition_by``.
+        """
+        import whoosh.query
+
+        app = _get_app(cls)
+        with Whooshee.searcher(app, cls, partition) as searcher:
+            query = cls._parse(searcher, search_string, group, match_substrings)
+            if estimate and not filters:
+                if search_filter is not None:
+                    query = whoosh.query.And([query, search_filter])
+                return query.estimate_size(searcher.reader())
+            allow = cls._combine_filters(app, searcher, search_filter, filters, as_docs=True,
+                                         partition=partition)
+            return sum(1 for _ in cls._matching_docs(searcher, query, allow))
+
+    @classmethod
+    def exists(cls, search_string, group=None, match_substrings=True, search_filter=None,
+               filters=(), partition=None):
+        """Returns ``True`` if any record matches the search string. The
+        search stops at the first match.
+
+        The arguments are the same as of :meth:`count`.
+        """
+        app = _get_app(cls)
+        with Whooshee.searcher(app, cls, partition) as searcher:
+            query = cls._parse(searcher, search_string, group, match_substrings)
+            allow = cls._combine_filters(app, searcher, search_filter, filters, as_docs=True,
+                                         partition=partition)
+            for _ in cls._matching_docs(searcher, query, allow):
+                return True
+            return False
+
+    @classmethod
+    def _parse(cls, searcher, search_string, group, match_substrings):
+        """Parses the search string into a whoosh query over the searched
+        fields."""
+        import whoosh.fields
+        import whoosh.qparser
+
+        if group is None:
+            group = whoosh.qparser.OrGroup
+        fieldnames = cls.search_fields or cls.schema.names()
+        if all(isinstance(cls.schema[f], whoosh.fields.NGRAM) for f in fieldnames):
+            # n-gram fields match substrings by plain term lookups
+            match_substrings = False
+        prepped_string = cls.prep_search_string(search_string, match_substrings)
+        parser = whoosh.qparser.MultifieldParser(fieldnames, searcher.schema, group=group)
+        return parser.parse(prepped_string)
+
+    @classmethod
+    def _combine_filters(cls, app, searcher, search_filter, filters, as_docs=False,
+                         partition=None):
+        """Combines the ``search_filter`` argument of whoosh searches with the
+        documents of the named cached filters. If ``as_docs`` is ``True``,
+        a query filter is turned into a set of document numbers."""
+        import whoosh.idsets
+        import whoosh.query
+
+        if isinstance(search_filter, whoosh.query.Query) and (filters or as_docs):
+            search_filter = whoosh.idsets.BitSet(search_filter.docs(searcher),
+                                                 size=searcher.doc_count_all())
+        if not filters:
+            return search_filter
+        docs = cls._filter_docs(app, searcher, filters, partition)
+        if search_filter is not None:
+            if not isinstance(search_filter, whoosh.idsets.DocIdSet):
+                search_filter = whoosh.idsets.BitSet(search_filter, size=searcher.doc_count_all())
+            docs = docs.intersection(search_filter)
+        return docs
+
+    @staticmethod
+    def _matching_docs(searcher, query, allow=None, deadline=None):
+        """Yields the (global) numbers of the documents matching the query
+        and the ``allow`` set, without scoring them. Raises
+        :class:`whoosh.searching.TimeLimit` once ``time.time()`` passes the
+        ``deadline``."""
+        from whoosh.searching import TimeLimit
+
+        for subsearcher, offset in searcher.leaf_searchers():
+            if deadline is not None and time.time() > deadline:
+                raise TimeLimit
+            for i, docnum in enumerate(query.matcher(subsearcher).all_ids()):
+                # checking the time is relatively expensive
+                if deadline is not None and not i % 256 and time.time() > deadline:
+                    raise TimeLimit
+                if allow is None or docnum + offset in allow:
+                    yield docnum + offset
+
+    @classmethod
+    def _filter_docs(cls, app, searcher, names, partition=None):
+        """Returns the set of (global) document numbers of the searcher (of
+        the given partition) matching all of the given cached filters.
+
+        The documents matching a filter are cached per segment (deleted
+        documents never match the searched query, so they don't matter) and
+        combined again only when the set of segments changes.
+        """
+        import whoosh.idsets
+
+        config = app.extensions['whooshee']
+        partition = _partition_name(cls, partition)
+        result = None
+        for name in names:
+            query = cls.cached_filters[name]
+            leaves = searcher.leaf_searchers()
+            segids = tuple(_segment_id(sub) for sub, offset in leaves)
+            key, docs = config['filters_cache'].get((cls, partition, name), (None, None))
+            if key != segids or None in segids:
+                local_docs = _per_segment(
+                    config['segments_cache'], (cls, partition, 'filter', name), leaves,
+                    lambda sub: whoosh.idsets.BitSet(query.docs(sub), size=sub.doc_count_all()))
+                docs = whoosh.idsets.BitSet(size=searcher.doc_count_all())
+                for (sub, offset), local in zip(leaves, local_docs):
+                    docs.update(docnum + offset for docnum in local)
+                config['filters_cache'][(cls, partition, name)] = (segids, docs)
+            result = docs if result is None else result.intersection(docs)
+        return result
+
+    @classmethod
+    def autocomplete(cls, prefix, limit=10, display_field=None, partition=None):
+        """Suggests completions for a partially typed search string. The last
+        word of ``prefix`` is completed from the terms of the searched fields
+        that start with it, the most frequent first. No database queries are
+        made, so this is cheap enough to be called on every keystroke.
+
+        If ``display_field`` is given, the distinct stored values of this
+        field of the ``limit`` best matching documents are returned instead.
+        The documents must contain all the preceding words and a word starting
+        with the last one.
+
+        :param prefix: The partially typed search string.
+        :param limit: The maximum number of returned suggestions.
+        :param display_field: Name of a stored field to return the values of.
+        :param partition: The partition to complete from if the whoosheer has
+                          ``partition_by``.
+        """
+        import heapq
+        import whoosh.fields
+        import whoosh.query
+
+        words = prefix.lower().split()
+        if not words:
+            return []
+        text_types = (whoosh.fields.TEXT, whoosh.fields.KEYWORD, whoosh.fields.NGRAM)
+        fieldnames = [f for f in cls.search_fields or cls.schema.names()
+                      if isinstance(cls.schema[f], text_types)]
+        app = _get_app(cls)
+        with Whooshee.searcher(app, cls, partition) as searcher:
+            if display_field:
+                def fields_query(word, query_class):
+                    return whoosh.query.Or([query_class(f, word) for f in fieldnames])
+                query = whoosh.query.And(
+                    [fields_query(w, whoosh.query.Term) for w in words[:-1]] +
+                    [fields_query(words[-1], whoosh.query.Prefix)])
+                values = []
+                for hit in searcher.search(query, limit=limit):
+                    value = hit.get(display_field)
+                    if value is not None and value not in values:
+                        values.append(value)
+                return values
+
+            # n-gram fields don't contain whole words
+            fieldnames = [f for f in fieldnames
+                          if not isinstance(cls.schema[f], whoosh.fields.NGRAM)]
+            reader = searcher.reader()
+            frequencies = {}
+            for fieldname in fieldnames:
+                for btext, terminfo in reader.iter_prefix(fieldname, words[-1]):
+                    term = btext.decode('utf-8')
+                    frequencies[term] = frequencies.get(term, 0) + terminfo.doc_frequency()
+        completed = ' '.join(words[:-1] + [''])
+        return [completed + term
+                for term in heapq.nsmallest(limit, frequencies, key=lambda t: (-frequencies[t], t))]
 
     @classmethod
     def prep_search_string(cls, search_string, match_substrings):
@@ -248,8 +1631,8 @@ class Whooshee(object):
 
     def init_app(self, app):
         """Initialize the extension. It will create the `index_path_root`
-        directory upon initalization but it will **not** create the index.
-        Please use :meth:`reindex` for this.
+        directory upon initalization (unless ``WHOOSHEE_LAZY`` is set) but it
+        will **not** create the index. Please use :meth:`reindex` for this.
 
         :param app: The application instance for which the extension should
                     be initialized.
@@ -259,21 +1642,65 @@ class Whooshee(object):
         config = app.extensions.setdefault('whooshee', {})
         # mapping that caches whoosheers to their indexes; used by `get_or_create_index`
         config['whoosheers_indexes'] = {}
+        # pools of open searchers reused between searches; used by `get_searcher`
+        config['whoosheers_searchers'] = {}
+        config['searchers_lock'] = threading.Lock()
+        # recently used partition indexes, the least recent are closed; see `get_or_create_index`
+        config['partitions_lru'] = OrderedDict()
+        config['partition_cache_size'] = app.config.get('WHOOSHEE_PARTITION_CACHE_SIZE', 100)
+        # values computed per index segment, e.g. document sets of cached filters;
+        # see `_per_segment`
+        config['segments_cache'] = {}
+        # document sets of the whoosheers' cached filters; used by `_filter_docs`
+        config['filters_cache'] = {}
+        # process that opened the cached indexes and searchers, see `_assure_own_process`
+        config['pid'] = os.getpid()
         # store a reference to self whoosheers; this way, even whoosheers created after init_app
         # was called will be found
         config['whoosheers'] = self.whoosheers
         config['index_path_root'] = app.config.get('WHOOSHEE_DIR', '') or 'whooshee'
         config['writer_timeout'] = app.config.get('WHOOSHEE_WRITER_TIMEOUT', 2)
+        # passed to `whoosh.filedb.filestore.FileStorage` and to the index writers
+        config['storage_options'] = app.config.get('WHOOSHEE_STORAGE_OPTIONS', {})
+        config['writer_options'] = app.config.get('WHOOSHEE_WRITER_OPTIONS', {})
         config['search_string_min_len'] = app.config.get('WHOOSHEE_MIN_STRING_LEN', 3)
         config['memory_storage'] = app.config.get("WHOOSHEE_MEMORY_STORAGE", False)
+        config['memory_snapshot'] = app.config.get('WHOOSHEE_MEMORY_SNAPSHOT', None)
+        config['database_storage'] = app.config.get('WHOOSHEE_DATABASE_STORAGE', False)
+        config['database_lock_expiry'] = app.config.get('WHOOSHEE_DATABASE_LOCK_EXPIRY', 600)
+        config['memory_bootstrap'] = app.config.get('WHOOSHEE_MEMORY_BOOTSTRAP', False)
+        config['bootstrap_chunk'] = app.config.get('WHOOSHEE_BOOTSTRAP_CHUNK', 1000)
+        limit = app.config.get('WHOOSHEE_MEMORY_LIMIT_MB', None)
+        config['memory_limit'] = limit * 1024 * 1024 if limit else None
         config['enable_indexing'] = app.config.get('WHOOSHEE_ENABLE_INDEXING', True)
+        config['lazy'] = app.config.get('WHOOSHEE_LAZY', False)
+        config['outbox'] = app.config.get('WHOOSHEE_OUTBOX', False)
+        config['indexer_socket'] = app.config.get('WHOOSHEE_INDEXER_SOCKET', None)
+        config['indexer_timeout'] = app.config.get('WHOOSHEE_INDEXER_TIMEOUT', 10)
+        config['journal'] = app.config.get('WHOOSHEE_JOURNAL', False)
+        config['read_only'] = app.config.get('WHOOSHEE_READ_ONLY', False)
+        # only memory storage indexes differ between the processes
+        config['broadcast_socket'] = app.config.get('WHOOSHEE_BROADCAST_SOCKET', None) \
+            if config['memory_storage'] else None
+        # connection to the broadcaster of this process, see `_subscribe`
+        config['subscription'] = None
+        # journal of the changes this process hasn't indexed yet, see `_get_journal`
+        config['journal_file'] = None
+        # the extension itself; used by the `flask whooshee` commands
+        config['extension'] = self
+        config['search_timeout'] = app.config.get('WHOOSHEE_SEARCH_TIMEOUT', None)
+        # number of searches stopped by the timeout
+        config['search_timeouts'] = 0
 
         if app.config.get('WHOOSHE_MIN_STRING_LEN', None) is not None:
             warnings.warn(WhoosheeDeprecationWarning("The config key WHOOSHE_MIN_STRING_LEN has been renamed to WHOOSHEE_MIN_STRING_LEN. The mispelled config key is deprecated and will be removed in upcoming releases. Change it to WHOOSHEE_MIN_STRING_LEN to suppress this warning"))
             config['search_string_min_len'] = app.config.get('WHOOSHE_MIN_STRING_LEN')
 
-        _assure_dirs_exists(config['index_path_root'])
+        if not config['lazy'] and not config['read_only']:
+            _assure_dirs_exists(config['index_path_root'])
 
+        if hasattr(app, 'cli'):
+            app.cli.add_command(_make_cli())
 
     def register_whoosheer(self, wh):
         """This will register the given whoosher on `whoosheers`, create the
@@ -288,6 +1715,10 @@ class Whooshee(object):
             event.listen(model, 'after_{0}'.format(INSERT_KWD), self.after_insert)
             event.listen(model, 'after_{0}'.format(UPDATE_KWD), self.after_update)
             event.listen(model, 'after_{0}'.format(DELETE_KWD), self.after_delete)
+            if wh.partition_by:
+                # the old partition of a changed record is loaded, see `_old_partitions`
+                event.listen(getattr(model, wh.partition_by), 'set', _load_old_value,
+                             active_history=True)
             query_class = getattr(model, 'query_class', None)
 
             if query_class is not None and isclass(query_class):
@@ -314,24 +1745,64 @@ class Whooshee(object):
         """Registers a single model for fulltext search. This basically creates
         a simple Whoosheer for the model and calls :func:`register_whoosheer`
         on it.
+
+        The given fields are indexed as :class:`whoosh.fields.TEXT`, all other
+        keyword arguments are passed to it. Pass ``ngram=(minsize, maxsize)``
+        to index them as :class:`whoosh.fields.NGRAMWORDS` instead, so that
+        substrings are matched by plain term lookups rather than by
+        wildcard queries scanning the whole term dictionary. A searched word
+        longer than ``maxsize`` is matched by all its grams, which may come
+        from different words of the field, so such searches can return
+        records that don't contain the word itself.
+
+        With ``typed=True``, integer, numeric, date, boolean and enum columns
+        are indexed as :class:`whoosh.fields.NUMERIC`,
+        :class:`whoosh.fields.DATETIME`, :class:`whoosh.fields.BOOLEAN` and
+        :class:`whoosh.fields.KEYWORD` fields, which can be filtered and sorted
+        on in the index. ``field_types`` maps column names to whoosh field
+        types to use instead of the default ones. Only ``TEXT`` and n-gram
+        fields (and the primary key) are searched by the search string.
+
+        Columns listed in ``sortable`` are stored in the index as columns, so
+        that search results can be efficiently sorted by them (see the
+        ``sort_by`` argument of :meth:`WhoosheeQuery.whooshee_search`).
+        Sortable columns don't need to be among the indexed fields; if they
+        are not, they are indexed by their types but not searched.
+
+        ``cached_filters`` maps names to whoosh queries searches can be
+        restricted by, see the ``filters`` argument of
+        :meth:`WhoosheeQuery.whooshee_search`.
+
+        ``partition_by`` names a column (e.g. the tenant) splitting the index
+        into a separate index per its value; searches then have to pass the
+        ``partition`` to search. Records without the value are indexed in the
+        ``''`` partition.
         """
+        ngram = kw.pop('ngram', None)
+        partition_by = kw.pop('partition_by', None)
+        typed = kw.pop('typed', False)
+        field_types = kw.pop('field_types', {})
+        sortable = kw.pop('sortable', ())
+        cached_filters = kw.pop('cached_filters', {})
         # construct subclass of AbstractWhoosheer for a model
         class ModelWhoosheer(AbstractWhoosheerMeta):
             @classmethod
             def _assign_primary(cls, primary, primary_is_numeric, attrs, model):
                 attrs[primary] = getattr(model, primary)
                 if not primary_is_numeric:
-                    if sys.version < '3':
-                        attrs[primary] = unicode(attrs[primary])
-                    else:
-                        attrs[primary] = str(attrs[primary])
+                    attrs[primary] = _to_text(attrs[primary])
 
 
         mwh = ModelWhoosheer
 
         def inner(model):
+            import whoosh.fields
+
             mwh.index_subdir = model.__tablename__
             mwh.models = [model]
+            mwh.cached_filters = cached_filters
+            mwh.partition_by = partition_by
+            all_fields = list(index_fields) + [f for f in sortable if f not in index_fields]
 
             schema_attrs = {}
             for field in model.__table__.columns:
@@ -348,37 +1819,58 @@ class Whooshee(object):
                         primary_is_numeric = False
                         schema_attrs[field.name] = whoosh.fields.ID(stored=True, unique=True)
                 elif field.name in index_fields:
-                    schema_attrs[field.name] = whoosh.fields.TEXT(**kw)
+                    if field.name in field_types:
+                        schema_attrs[field.name] = field_types[field.name]
+                    elif typed and _typed_field(field.type) is not None:
+                        schema_attrs[field.name] = _typed_field(field.type)
+                    elif ngram:
+                        schema_attrs[field.name] = whoosh.fields.NGRAMWORDS(ngram[0], ngram[1],
+                                                                            **kw)
+                    else:
+                        schema_attrs[field.name] = whoosh.fields.TEXT(**kw)
+                elif field.name in sortable:
+                    schema_attrs[field.name] = (field_types.get(field.name) or
+                                                _typed_field(field.type) or
+                                                whoosh.fields.ID())
+            for f in sortable:
+                schema_attrs[f].set_sortable(True)
             mwh.schema = whoosh.fields.Schema(**schema_attrs)
+            text_fields = [f for f in index_fields
+                           if isinstance(mwh.schema[f], (whoosh.fields.TEXT, whoosh.fields.NGRAM))]
+            if ngram:
+                # don't run wildcard queries against the primary key
+                mwh.search_fields = text_fields
+            elif len(text_fields) < len(all_fields):
+                # typed fields are meant for filtering and sorting, e.g. BOOLEAN
+                # fields would match any search string
+                mwh.search_fields = [primary] + text_fields
+            typed_fields = set(all_fields) - set(text_fields)
             # we can't check with isinstance, because ModelWhoosheer is private
             # so use this attribute to find out
             mwh._is_model_whoosheer = True
 
+            def document(model):
+                attrs = {}
+                mwh._assign_primary(primary, primary_is_numeric, attrs, model)
+                for f in all_fields:
+                    value = getattr(model, f)
+                    if f in typed_fields:
+                        # typed fields can't index None, leave them out instead
+                        if value is not None:
+                            attrs[f] = _field_value(mwh.schema[f], value)
+                    elif isinstance(value, int):
+                        attrs[f] = value
+                    else:
+                        attrs[f] = _to_text(value)
+                return attrs
+
             @classmethod
             def update_model(cls, writer, model):
-                attrs = {}
-                cls._assign_primary(primary, primary_is_numeric, attrs, model)
-                for f in index_fields:
-                    attrs[f] = getattr(model, f)
-                    if not isinstance(attrs[f], int):
-                        if sys.version < '3':
-                            attrs[f] = unicode(attrs[f])
-                        else:
-                            attrs[f] = str(attrs[f])
-                writer.update_document(**attrs)
+                writer.update_document(**document(model))
 
             @classmethod
             def insert_model(cls, writer, model):
-                attrs = {}
-                cls._assign_primary(primary, primary_is_numeric, attrs, model)
-                for f in index_fields:
-                    attrs[f] = getattr(model, f)
-                    if not isinstance(attrs[f], int):
-                        if sys.version < '3':
-                            attrs[f] = unicode(attrs[f])
-                        else:
-                            attrs[f] = str(attrs[f])
-                writer.add_document(**attrs)
+                writer.add_document(**document(model))
 
             @classmethod
             def delete_model(cls, writer, model):
@@ -389,36 +1881,186 @@ class Whooshee(object):
             setattr(mwh, '{0}_{1}'.format(DELETE_KWD, model.__name__.lower()), delete_model)
             model._whoosheer_ = mwh
             model.whoosh_search = mwh.search
+            model.whoosh_autocomplete = mwh.autocomplete
             self.register_whoosheer(mwh)
             return model
 
         return inner
 
     @classmethod
-    def create_index(cls, app, wh):
+    def create_index(cls, app, wh, partition=None):
         """Creates and opens an index for the given whoosheer and app.
         If the index already exists, it just opens it, otherwise it creates
         it first.
 
         :param app: The application instance.
         :param wh: The whoosheer instance for which a index should be created.
+        :param partition: The partition of the index if the whoosheer has
+                          ``partition_by``.
         """
-        # TODO: do we really want/need to use camel casing?
-        # everywhere else, there is just .lower()
+        import whoosh.index
+
+        partition = _partition_name(wh, partition)
+        if app.extensions['whooshee']['read_only']:
+            # never creates the index or takes its write lock
+            storage = cls._file_storage(app, cls._index_path(app, wh, partition), readonly=True)
+            return storage.open_index()
         if app.extensions['whooshee']['memory_storage']:
-            storage = RamStorage()
-            index = storage.create_index(wh.schema)
-            assert index
-            return index
+            return cls._create_memory_index(app, wh, partition)
+        elif app.extensions['whooshee']['database_storage']:
+            storage = cls._database_storage(app, wh, partition).create()
+            if storage.index_exists():
+                return storage.open_index()
+            return storage.create_index(wh.schema)
         else:
-            index_path = os.path.join(app.extensions['whooshee']['index_path_root'],
-                                      getattr(wh, 'index_subdir', cls.camel_to_snake(wh.__name__)))
+            index_path = cls._index_path(app, wh, partition)
             if whoosh.index.exists_in(index_path):
-                index = whoosh.index.open_dir(index_path)
+                index = cls._file_storage(app, index_path).open_index()
             else:
                 _assure_dirs_exists(index_path)
-                index = whoosh.index.create_in(index_path, wh.schema)
+                index = cls._file_storage(app, index_path).create_index(wh.schema)
+            return index
+
+    @classmethod
+    def _database_storage(cls, app, wh, partition=None):
+        """Returns the database storage of the whoosheer's index, caching
+        the index files in ``_cache`` of ``WHOOSHEE_DIR``."""
+        config = app.extensions['whooshee']
+        subdir = cls._index_subdir(wh, partition)
+        return _database_storage(
+            _get_engine(app), subdir, os.path.join(config['index_path_root'], '_cache', subdir),
+            supports_mmap=config['storage_options'].get('supports_mmap', True),
+            lock_expiry=config['database_lock_expiry'])
+
+    @classmethod
+    def _file_storage(cls, app, path, **kwargs):
+        """Returns the file storage in ``path`` with the options of
+        ``WHOOSHEE_STORAGE_OPTIONS``."""
+        from whoosh.filedb.filestore import FileStorage
+
+        options = dict(app.extensions['whooshee']['storage_options'])
+        options.update(kwargs)
+        return FileStorage(path, **options)
+
+    @classmethod
+    def _create_memory_index(cls, app, wh, partition=None):
+        """Creates the memory storage index of the whoosheer, loading it
+        from ``WHOOSHEE_MEMORY_SNAPSHOT`` or populating it from the database
+        with ``WHOOSHEE_MEMORY_BOOTSTRAP``. Falls back to the file index if
+        the index doesn't fit in ``WHOOSHEE_MEMORY_LIMIT_MB``."""
+        from whoosh.filedb.filestore import FileStorage
+
+        config = app.extensions['whooshee']
+        if config['memory_snapshot']:
+            subdir = cls._index_subdir(wh, partition)
+            source = os.path.join(config['memory_snapshot'], subdir)
+            names = _snapshot_files(config['memory_snapshot'], subdir)
+            if names is not None:
+                size = sum(os.path.getsize(os.path.join(source, name)) for name in names)
+                if config['memory_limit'] and size > config['memory_limit']:
+                    return cls._fall_back_to_files(app, wh, FileStorage(source), size, partition)
+                return _load_into_memory(source, names)
+        index = _ram_storage().create_index(wh.schema)
+        assert index
+        if config['memory_bootstrap']:
+            index = cls._bootstrap(app, wh, index, partition)
+        return index
+
+    @classmethod
+    def _bootstrap(cls, app, wh, index, partition=None):
+        """Indexes all records of the whoosheer's models (in the partition),
+        streaming them from the database and committing in chunks of
+        ``WHOOSHEE_BOOTSTRAP_CHUNK`` records."""
+        config = app.extensions['whooshee']
+        chunk = config['bootstrap_chunk']
+        for model in wh.models:
+            method = getattr(wh, '{0}_{1}'.format(UPDATE_KWD, model.__name__.lower()))
+            query = model.query
+            if partition is not None:
+                column = getattr(model, wh.partition_by)
+                query = query.filter(column.is_(None) if partition == u'' else column == partition)
+            writer = None
+            for i, item in enumerate(query.yield_per(chunk), 1):
+                if writer is None:
+                    writer = _index_writer(index, config)
+                method(writer, item)
+                if i % chunk == 0:
+                    writer.commit()
+                    writer = None
+                    index = cls._limit_memory(app, wh, index, partition)
+            if writer is not None:
+                writer.commit()
+                index = cls._limit_memory(app, wh, index, partition)
+        return index
+
+    @classmethod
+    def _limit_memory(cls, app, wh, index, partition=None):
+        """Returns the given index or, if it's a memory storage index over
+        ``WHOOSHEE_MEMORY_LIMIT_MB``, the file index it's moved to."""
+        from whoosh.filedb.filestore import RamStorage
+
+        limit = app.extensions['whooshee']['memory_limit']
+        if not limit or not isinstance(index.storage, RamStorage):
+            return index
+        size = index.storage.total_size()
+        if size <= limit:
             return index
+        return cls._fall_back_to_files(app, wh, index.storage, size, partition)
+
+    @classmethod
+    def _fall_back_to_files(cls, app, wh, storage, size, partition=None):
+        import whoosh.index
+
+        warnings.warn('The index of {0} takes {1:.1f} MB, over WHOOSHEE_MEMORY_LIMIT_MB, '
+                      'using file storage instead'.format(wh.__name__, size / 1024.0 / 1024))
+        index_path = cls._index_path(app, wh, partition)
+        _assure_dirs_exists(index_path)
+        files = cls._file_storage(app, index_path)
+        indexname = whoosh.index._DEF_INDEX_NAME
+        with _write_lock(files, app.extensions['whooshee']):
+            # other processes may have fallen back and written to the file index
+            # already, only an older one is replaced
+            if (whoosh.index.TOC._latest_generation(files, indexname) <
+                    whoosh.index.TOC._latest_generation(storage, indexname)):
+                # the index files are the same for both storages
+                _publish_generation(storage, indexname, index_path, link=True)
+        return files.open_index()
+
+    @classmethod
+    def _index_path(cls, app, wh, partition=None):
+        return os.path.join(app.extensions['whooshee']['index_path_root'],
+                            cls._index_subdir(wh, partition))
+
+    @classmethod
+    def _index_subdir(cls, wh, partition=None):
+        # TODO: do we really want/need to use camel casing?
+        # everywhere else, there is just .lower()
+        subdir = getattr(wh, 'index_subdir', cls.camel_to_snake(wh.__name__))
+        if partition is None:
+            return subdir
+        # used in paths as well as in snapshot manifests and database storage names
+        return '{0}/{1}'.format(subdir, _partition_dir(partition))
+
+    @classmethod
+    def _partitions(cls, app, wh):
+        """Returns the partitions of the whoosheer's index that exist."""
+        config = app.extensions['whooshee']
+        subdir = cls._index_subdir(wh)
+        if config['memory_storage']:
+            return sorted(key[1] for key in config['whoosheers_indexes']
+                          if isinstance(key, tuple) and key[0] is wh)
+        if config['database_storage']:
+            prefix = subdir + '/'
+            with _get_engine(app).connect() as connection:
+                names = connection.execute(
+                    sqlalchemy.select(files_table.c.index_name).distinct().where(
+                        files_table.c.index_name.startswith(prefix, autoescape=True))).scalars()
+                return sorted(_dir_partition(name[len(prefix):]) for name in names)
+        index_path = cls._index_path(app, wh)
+        if not os.path.isdir(index_path):
+            return []
+        return sorted(_dir_partition(name) for name in os.listdir(index_path)
+                      if not name.startswith('.') and os.path.isdir(os.path.join(index_path, name)))
 
     @classmethod
     def camel_to_snake(self, s):
@@ -429,66 +2071,1099 @@ class Whooshee(object):
         return self._underscore_re2.sub(r'\1_\2', self._underscore_re1.sub(r'\1_\2', s)).lower()
 
     @classmethod
-    def get_or_create_index(cls, app, wh):
+    def get_or_create_index(cls, app, wh, partition=None):
         """Gets a previously cached index or creates a new one for the
-        given app and whoosheer.
+        given app and whoosheer. At most ``WHOOSHEE_PARTITION_CACHE_SIZE``
+        partition indexes are kept open, the least recently used ones are
+        closed.
 
         :param app: The application instance.
         :param wh: The whoosheer instance for which the index should be
                    retrieved or created.
+        :param partition: The partition of the index if the whoosheer has
+                          ``partition_by``.
         """
-        if wh in app.extensions['whooshee']['whoosheers_indexes']:
-            return app.extensions['whooshee']['whoosheers_indexes'][wh]
-        index = cls.create_index(app, wh)
-        app.extensions['whooshee']['whoosheers_indexes'][wh] = index
+        config = app.extensions['whooshee']
+        partition = _partition_name(wh, partition)
+        key = _index_key(wh, partition)
+        _assure_own_process(config)
+        if config['broadcast_socket']:
+            config['extension']._subscribe(app)
+        if key in config['whoosheers_indexes']:
+            if partition is not None:
+                with config['searchers_lock']:
+                    config['partitions_lru'].pop(key, None)
+                    config['partitions_lru'][key] = True
+            return config['whoosheers_indexes'][key]
+        index = cls.create_index(app, wh, partition)
+        config['whoosheers_indexes'][key] = index
+        if partition is not None and not config['memory_storage']:
+            # memory indexes would be lost, so they're kept
+            cls._close_partitions(config, key)
         return index
 
+    @classmethod
+    def _close_partitions(cls, config, opened):
+        with config['searchers_lock']:
+            lru = config['partitions_lru']
+            lru.pop(opened, None)
+            lru[opened] = True
+            while len(lru) > config['partition_cache_size']:
+                key = lru.popitem(last=False)[0]
+                config['whoosheers_indexes'].pop(key, None)
+                # the values cached per segment of the partition, keyed by (wh, partition, ...)
+                for cache in (config['segments_cache'], config['filters_cache']):
+                    for cache_key in [k for k in cache if k[:2] == key]:
+                        del cache[cache_key]
+                # the searchers in use are closed when released
+                for searcher in config['whoosheers_searchers'].pop(key, []):
+                    searcher.close()
+
+    @classmethod
+    def get_searcher(cls, app, wh, partition=None):
+        """Takes an open searcher for the given app and whoosheer out of the
+        pool of searchers kept between searches, refreshing it if the index
+        has changed since it was opened. A new searcher is opened if the pool
+        is empty. Searchers are not thread safe, so every searcher is used by
+        a single caller at a time and should be handed back by
+        :meth:`release_searcher` once it's not needed anymore.
+
+        :param app: The application instance.
+        :param wh: The whoosheer instance for which the searcher should be
+                   retrieved.
+        :param partition: The partition of the index if the whoosheer has
+                          ``partition_by``.
+        """
+        config = app.extensions['whooshee']
+        key = _index_key(wh, _partition_name(wh, partition))
+        _assure_own_process(config)
+        with config['searchers_lock']:
+            pool = config['whoosheers_searchers'].get(key)
+            searcher = pool.pop() if pool else None
+        index = cls.get_or_create_index(app, wh, partition)
+        if searcher is None:
+            return index.searcher()
+        if searcher._ix is not index:
+            # the index was replaced since, e.g. moved to files or restored
+            searcher.close()
+            return index.searcher()
+        return searcher.refresh()
+
+    @classmethod
+    def release_searcher(cls, app, wh, searcher, partition=None):
+        """Puts a searcher obtained by :meth:`get_searcher` back to the pool,
+        or closes it if its index was closed or replaced meanwhile.
+
+        :param app: The application instance.
+        :param wh: The whoosheer instance the searcher belongs to.
+        :param searcher: The searcher to put back.
+        :param partition: The partition the searcher belongs to.
+        """
+        config = app.extensions['whooshee']
+        key = _index_key(wh, _partition_name(wh, partition))
+        with config['searchers_lock']:
+            if searcher._ix is not config['whoosheers_indexes'].get(key):
+                # the index was closed or replaced meanwhile (e.g. moved to
+                # files or restored), the searcher would keep its old contents
+                searcher.close()
+                return
+            config['whoosheers_searchers'].setdefault(key, []).append(searcher)
+
+    @classmethod
+    @contextmanager
+    def searcher(cls, app, wh, partition=None):
+        """Context manager that borrows a searcher from the pool for the
+        duration of the block, see :meth:`get_searcher`.
+
+        :param app: The application instance.
+        :param wh: The whoosheer instance for which the searcher should be
+                   retrieved.
+        :param partition: The partition of the index if the whoosheer has
+                          ``partition_by``.
+        """
+        searcher = cls.get_searcher(app, wh, partition)
+        try:
+            yield searcher
+        finally:
+            cls.release_searcher(app, wh, searcher, partition)
+
+    def warmup(self):
+        """Opens the indexes of all registered whoosheers and preloads their
+        term dictionaries into searchers that are kept for the following
+        searches, so that the first search after application start doesn't
+        have to pay for it. Call it at application startup, e.g. right after
+        :meth:`init_app` or before forking worker processes. The whoosheers
+        with ``partition_by`` are skipped, their partitions are opened on
+        demand.
+        """
+        app = _get_app(self)
+        for wh in self.whoosheers:
+            if wh.partition_by:
+                continue
+            with type(self).searcher(app, wh) as searcher:
+                reader = searcher.reader()
+                for fieldname in reader.indexed_field_names():
+                    for _ in reader.lexicon(fieldname):
+                        pass
+
+    def search_many(self, searches, parallel=False, max_workers=None):
+        """Runs several searches at once and returns the list of their
+        results (see :meth:`AbstractWhoosheer.search`) in the same order.
+        All searches of the same whoosheer and partition share a single
+        searcher.
+
+        Each search is a dict of the arguments of
+        :meth:`AbstractWhoosheer.search` with the ``whoosheer`` (or the model
+        registered by :meth:`register_model`) under the ``whoosheer`` key.
+        ``values_of`` defaults to the unique field of the whoosheer::
+
+            entries, users = whooshee.search_many([
+                {'whoosheer': Entry, 'search_string': 'chuck', 'limit': 10},
+                {'whoosheer': User, 'search_string': 'chuck', 'limit': 5},
+            ])
+
+        :param searches: The list of the searches.
+        :param parallel: ``True`` to search the different whoosheers in
+                         parallel threads.
+        :param max_workers: The maximum number of the threads.
+        """
+        app = _get_app(self)
+        # the threads need the app itself, not the context local proxy
+        app = getattr(app, '_get_current_object', lambda: app)()
+        groups = {}
+        for i, search in enumerate(searches):
+            kwargs = dict(search)
+            wh = kwargs.pop('whoosheer')
+            wh = getattr(wh, '_whoosheer_', wh)
+            kwargs.setdefault('values_of', _unique_field(wh))
+            if not kwargs['values_of']:
+                # the results would keep using the shared searcher
+                raise ValueError('search_many needs values_of for all searches')
+            partition = kwargs.pop('partition', None)
+            groups.setdefault((wh, partition), []).append((i, kwargs))
+        results = [None] * len(searches)
+
+        def run(wh, partition, group):
+            with type(self).searcher(app, wh, partition) as searcher:
+                for i, kwargs in group:
+                    results[i] = wh._search(searcher, partition=partition, **kwargs)
+
+        def run_in_thread(item):
+            (wh, partition), group = item
+            with app.app_context():
+                run(wh, partition, group)
+
+        if parallel and len(groups) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # consume the results to propagate exceptions
+                list(executor.map(run_in_thread, groups.items()))
+        else:
+            for (wh, partition), group in groups.items():
+                run(wh, partition, group)
+        return results
+
     def after_insert(self, mapper, connection, target):
-        self.on_commit([[target, INSERT_KWD]])
+        self._record_change(mapper, connection, target, INSERT_KWD)
 
     def after_delete(self, mapper, connection, target):
-        self.on_commit([[target, DELETE_KWD]])
+        self._record_change(mapper, connection, target, DELETE_KWD)
 
     def after_update(self, mapper, connection, target):
-        self.on_commit([[target, UPDATE_KWD]])
+        self._record_change(mapper, connection, target, UPDATE_KWD)
+
+    def _record_change(self, mapper, connection, target, operation):
+        """Indexes the change right away or, in the outbox mode, stores it
+        in the outbox table in the transaction of the change. With an
+        indexer socket, the journal, the broadcaster or the database storage
+        (whose writes would interfere with the transaction being flushed),
+        the change is kept in the session and indexed after the session
+        commits; the journal gets it right away."""
+        config = _get_config(self)
+        if config['enable_indexing'] is False or config['read_only']:
+            return
+        key = (target.__class__.__name__,
+               _to_text(mapper.primary_key_from_instance(target)[0]),
+               operation)
+        old_partitions = self._old_partitions(target, operation)
+        if old_partitions:
+            key += (old_partitions,)
+        if config['outbox']:
+            connection.execute(outbox_table.insert().values(
+                model=key[0], pk=key[1], operation=key[2],
+                partitions=json.dumps(old_partitions) if old_partitions else None))
+        elif (config['indexer_socket'] or config['journal'] or config['broadcast_socket'] or
+              config['database_storage']) and sqlalchemy.orm.object_session(target) is not None:
+            self._listen_to_sessions()
+            if config['journal']:
+                self._get_journal().append(key)
+            session = sqlalchemy.orm.object_session(target)
+            pending = session.info.setdefault(self._session_key, {})
+            pending.setdefault(session.get_nested_transaction(), []).append(key)
+        else:
+            self.on_commit([[target, operation, old_partitions]])
+
+    def _old_partitions(self, target, operation):
+        """Returns the partitions the changed record has to be removed from
+        as ``{partition_by: [values]}``: the old values of the changed
+        ``partition_by`` attributes, or all the values of a deleted record."""
+        attrs = set(wh.partition_by for wh in self.whoosheers
+                    if wh.partition_by and target.__class__ in wh.models)
+        if not attrs or operation == INSERT_KWD:
+            return {}
+        state = sqlalchemy.inspect(target)
+        old_partitions = {}
+        for attr in attrs:
+            # the committed value the record was indexed with
+            history = state.attrs[attr].history
+            if operation == DELETE_KWD:
+                values = history.deleted or history.unchanged or history.added
+                loaded = state.attrs[attr].loaded_value
+                if not values and loaded is not sqlalchemy.orm.attributes.NO_VALUE:
+                    values = [loaded]
+            else:
+                values = history.deleted if history.added else ()
+            values = [u'' if value is None else _to_text(value) for value in values]
+            if values:
+                old_partitions[attr] = values
+        return old_partitions
+
+    @property
+    def _session_key(self):
+        # key of the changes waiting for the commit in `Session.info`, kept
+        # by the savepoint they were made in (``None`` outside of savepoints)
+        return ('whooshee', id(self))
+
+    def _listen_to_sessions(self):
+        if getattr(self, '_listening_to_sessions', False):
+            return
+        self._listening_to_sessions = True
+        event.listen(sqlalchemy.orm.Session, 'after_flush', self._after_session_flush)
+        event.listen(sqlalchemy.orm.Session, 'after_commit', self._after_session_commit)
+        event.listen(sqlalchemy.orm.Session, 'after_transaction_end',
+                     self._after_session_transaction_end)
+
+    def _after_session_flush(self, session, flush_context):
+        # the changes are on disk before the database commits them
+        if session.info.get(self._session_key) and _get_config(self)['journal']:
+            self._get_journal().sync()
+
+    def _after_session_commit(self, session):
+        savepoint = session.get_nested_transaction()
+        if savepoint is not None:
+            # a released savepoint, its changes wait for the enclosing transaction
+            pending = session.info.get(self._session_key, {})
+            changes = pending.pop(savepoint, None)
+            if changes:
+                parent = savepoint.parent
+                while parent is not None and not parent.nested:
+                    parent = parent.parent
+                pending.setdefault(parent, []).extend(changes)
+            return
+        pending = session.info.pop(self._session_key, None)
+        changes = [key for keys in (pending or {}).values() for key in keys]
+        if not changes:
+            return
+        if not _get_config(self)['journal']:
+            self._index_changes(changes)
+            return
+        journal = self._get_journal()
+        changes = journal.take_failed() + changes
+        try:
+            if not journal.replayed:
+                self.replay_journal()
+            self._index_changes(changes)
+        except _indexing_errors() as err:
+            warnings.warn('Failed to index {0} journaled changes, they will be retried: {1}'.format(
+                len(changes), err))
+            journal.done(len(changes), failed=changes)
+        else:
+            journal.done(len(changes))
+
+    def _after_session_transaction_end(self, session, transaction):
+        # drops the changes of a rolled back savepoint or transaction; committed
+        # ones were taken by `_after_session_commit` already
+        if transaction.nested:
+            changes = session.info.get(self._session_key, {}).pop(transaction, None)
+        elif transaction.parent is None:
+            pending = session.info.pop(self._session_key, None)
+            changes = [key for keys in (pending or {}).values() for key in keys]
+        else:
+            return
+        if changes and _get_config(self)['journal']:
+            self._get_journal().done(len(changes))
+
+    def _index_changes(self, changes):
+        config = _get_config(self)
+        if config['indexer_socket']:
+            self._send_to_indexer(changes)
+        else:
+            self._index_keys(changes)
+        if config['broadcast_socket']:
+            try:
+                self._subscribe(_get_app(self)).send(changes)
+            except socket.error as err:
+                warnings.warn('{0} changes not broadcast to the other processes: {1}'.format(
+                    len(changes), err))
+
+    def _subscribe(self, app):
+        """Returns the connection of this process to the broadcaster,
+        connecting on first use."""
+        config = app.extensions['whooshee']
+        with _process_lock:
+            subscription = config['subscription']
+            if subscription is None or subscription.pid != os.getpid():
+                # the subscription's threads need the app itself, not the proxy
+                app = getattr(app, '_get_current_object', lambda: app)()
+                subscription = config['subscription'] = _Subscription(
+                    self, app, config['broadcast_socket'])
+            return subscription
+
+    def _get_journal(self):
+        """Returns the journal of this process, opening it on first use."""
+        config = _get_config(self)
+        with _process_lock:
+            journal = config['journal_file']
+            if journal is None or journal.pid != os.getpid():
+                if journal is not None:
+                    # inherited from the parent process, which keeps using it
+                    journal.file.close()
+                directory = config['journal']
+                if directory is True:
+                    directory = os.path.join(config['index_path_root'], '_journal')
+                journal = config['journal_file'] = _Journal(directory)
+            return journal
+
+    def replay_journal(self):
+        """Indexes the changes left in the journals of processes that ended
+        before indexing them (see ``WHOOSHEE_JOURNAL``) and removes these
+        journals. This happens on the first commit of every process, call
+        it to replay the journals on startup instead. Returns the number of
+        replayed changes.
+        """
+        journal = self._get_journal()
+        journal.replayed = True
+        replayed = 0
+        for _, changes in journal.orphans():
+            if changes:
+                self._index_keys(changes)
+            replayed += len(changes)
+        return replayed
+
+    def _send_to_indexer(self, changes):
+        """Sends the ``(model name, primary key, operation)`` changes to the
+        indexer (see :class:`Indexer`) and waits until it commits them. If
+        the indexer can't be reached or fails, the changes are indexed right
+        away instead."""
+        config = _get_config(self)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(config['indexer_timeout'])
+            sock.connect(config['indexer_socket'])
+            sock.sendall((json.dumps({'changes': changes}) + '\n').encode('utf-8'))
+            response = json.loads(sock.makefile('rb').readline().decode('utf-8'))
+            if not response.get('ok'):
+                raise RuntimeError(response.get('error'))
+            return
+        except (socket.error, ValueError, RuntimeError) as err:
+            warnings.warn('Indexing {0} changes directly, the indexer failed: {1}'.format(
+                len(changes), err))
+        finally:
+            sock.close()
+        self._index_keys(changes)
 
     def on_commit(self, changes):
         """Method that gets called when a model is changed. This serves
         to do the actual index writing.
+
+        :param changes: The ``(instance, operation)`` changes, optionally with
+                        the ``{partition_by: [values]}`` partitions the
+                        records were indexed in before the change.
         """
         if _get_config(self)['enable_indexing'] is False:
             return None
 
+        self._apply_changes(changes)
+
+    def _apply_changes(self, changes):
+        """Writes the given ``(instance, operation[, old partitions])``
+        changes to the indexes of the whoosheers, committing a single writer
+        per whoosheer (or per partition of the whoosheers with
+        ``partition_by``). Records are removed from the partitions they were
+        moved out of."""
+        self._assure_writable()
+        app = _get_app(self)
         for wh in self.whoosheers:
             if not wh.auto_update:
                 continue
-            writer = None
-            for change in changes:
-                if change[0].__class__ in wh.models:
-                    method_name = '{0}_{1}'.format(change[1], change[0].__class__.__name__.lower())
-                    method = getattr(wh, method_name, None)
-                    if method:
-                        if not writer:
-                            writer = type(self).get_or_create_index(_get_app(self), wh).\
-                                writer(timeout=_get_config(self)['writer_timeout'])
-                        with writer:
-                            method(writer, change[0])
+            writers = OrderedDict()
+            try:
+                for change in changes:
+                    instance, operation = change[0], change[1]
+                    if instance.__class__ not in wh.models:
+                        continue
+                    model_name = instance.__class__.__name__.lower()
+                    method = getattr(wh, '{0}_{1}'.format(operation, model_name), None)
+                    if not wh.partition_by:
+                        if method:
+                            method(self._writer(writers, wh, None), instance)
+                        continue
+                    old_partitions = change[2] if len(change) > 2 and change[2] else {}
+                    stale = set(old_partitions.get(wh.partition_by, ()))
+                    if operation == DELETE_KWD:
+                        if not stale:
+                            # e.g. deleted records loaded by their keys have no partition
+                            stale = set(type(self)._partitions(app, wh))
+                    else:
+                        partition = _partition_of(wh, instance)
+                        if method:
+                            method(self._writer(writers, wh, partition), instance)
+                        stale.discard(partition)
+                    delete = getattr(wh, '{0}_{1}'.format(DELETE_KWD, model_name), None)
+                    if stale and delete:
+                        # no index is created for partitions that don't exist
+                        existing = set(type(self)._partitions(app, wh))
+                        for old in sorted(stale & existing):
+                            delete(self._writer(writers, wh, old), instance)
+            except Exception:
+                for writer in writers.values():
+                    writer.cancel()
+                raise
+            for partition, writer in writers.items():
+                writer.commit()
+                if _get_config(self)['memory_limit']:
+                    self._move_over_limit_index(wh, partition)
+
+    def _writer(self, writers, wh, partition):
+        # the writer of the whoosheer's (partition) index, opened on first use
+        partition = _partition_name(wh, partition)
+        if partition not in writers:
+            writers[partition] = _index_writer(
+                type(self).get_or_create_index(_get_app(self), wh, partition), _get_config(self))
+        return writers[partition]
+
+    def _move_over_limit_index(self, wh, partition=None):
+        app = _get_app(self)
+        config = _get_config(self)
+        key = _index_key(wh, _partition_name(wh, partition))
+        index = type(self).get_or_create_index(app, wh, partition)
+        moved = type(self)._limit_memory(app, wh, index, partition)
+        if moved is not index:
+            with config['searchers_lock']:
+                config['whoosheers_indexes'][key] = moved
+                # the searchers in use are closed when released
+                for searcher in config['whoosheers_searchers'].pop(key, []):
+                    searcher.close()
+
+    def create_tables(self):
+        """Creates the ``whooshee_outbox`` table used by the outbox mode
+        (see ``WHOOSHEE_OUTBOX``) and the ``whooshee_files`` and
+        ``whooshee_locks`` tables used by the database storage (see
+        ``WHOOSHEE_DATABASE_STORAGE``) if they don't exist yet."""
+        outbox_metadata.create_all(_get_engine(_get_app(self)))
+
+    def drain(self, batch_size=1000):
+        """Indexes the changes stored in the outbox table by the outbox mode
+        and removes them from it. The changes are processed in batches of
+        ``batch_size``; repeated changes of the same record are indexed only
+        once and each whoosheer's index is committed once per batch. The
+        indexed records are loaded from the database, records that no longer
+        exist are removed from the indexes. Returns the number of processed
+        changes.
+
+        The changes are removed from the outbox only after the indexes are
+        committed, so if the draining fails, they're indexed again next time.
+        Because of that, inserts are indexed with the ``update_<model>``
+        methods of the whoosheers.
+        """
+        engine = _get_engine(_get_app(self))
+        processed = 0
+        while True:
+            with engine.connect() as connection:
+                rows = connection.execute(
+                    outbox_table.select().order_by(outbox_table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                return processed
+            self._index_keys([(row.model, row.pk, row.operation,
+                               json.loads(row.partitions) if row.partitions else {})
+                              for row in rows])
+            with engine.begin() as connection:
+                connection.execute(outbox_table.delete().where(
+                    outbox_table.c.id.in_([row.id for row in rows])))
+            processed += len(rows)
+
+    def _index_keys(self, keys):
+        """Indexes changes given as ``(model name, primary key, operation)``
+        in the order they were made. Only the last change of each record
+        matters, as the records are loaded from the database by a separate
+        session; records that no longer exist are removed from the indexes.
+        """
+        models = dict((model.__name__, model) for wh in self.whoosheers for model in wh.models)
+        latest = {}
+        old_partitions = {}
+        for key in keys:
+            model_name, pk, operation = key[:3]
+            latest[(model_name, _to_text(pk))] = operation
+            # the record has to be removed from the partitions of all its changes
+            merged = old_partitions.setdefault((model_name, _to_text(pk)), {})
+            for attr, values in (key[3] if len(key) > 3 and key[3] else {}).items():
+                merged.setdefault(attr, []).extend(values)
+        by_model = {}
+        for (model_name, pk), operation in latest.items():
+            if model_name in models:
+                by_model.setdefault(models[model_name], []).append(
+                    (pk, operation, old_partitions[(model_name, pk)]))
+        session = sqlalchemy.orm.Session(bind=_get_engine(_get_app(self)))
+        try:
+            changes = []
+            for model, pks in by_model.items():
+                changes.extend(self._load_changes(session, model, pks))
+            # the whoosheers may load relationships of the records, keep the session open
+            self._apply_changes(changes)
+        finally:
+            session.close()
+
+    def _load_changes(self, session, model, pks):
+        """Returns the ``(instance, operation, old partitions)`` changes of
+        the model's records with the given ``(primary key, operation, old
+        partitions)`` entries."""
+        mapper = sqlalchemy.inspect(model)
+        column = mapper.primary_key[0]
+        try:
+            to_pk = column.type.python_type
+        except NotImplementedError:
+            to_pk = _to_text
+        pks = [(to_pk(pk), operation, old) for pk, operation, old in pks]
+        wanted = [pk for pk, operation, old in pks if operation != DELETE_KWD]
+        attr = mapper.get_property_by_column(column).key
+        found = {}
+        for start in range(0, len(wanted), 500):
+            batch = wanted[start:start + 500]
+            for instance in session.query(model).filter(getattr(model, attr).in_(batch)):
+                found[getattr(instance, attr)] = instance
+        changes = []
+        for pk, operation, old in pks:
+            if pk in found:
+                changes.append((found[pk], UPDATE_KWD, old))
+            else:
+                # deleted records are represented by new instances with just the primary key
+                instance = mapper.class_manager.new_instance()
+                setattr(instance, attr, pk)
+                changes.append((instance, DELETE_KWD, old))
+        return changes
+
+    def _assure_writable(self):
+        if _get_config(self)['read_only']:
+            from whoosh.filedb.filestore import ReadOnlyError
+            raise ReadOnlyError('The indexes of a read-only replica are never written')
+
+    def publish(self, path):
+        """Copies the latest committed generation of every index into
+        ``path``, from where read-only replicas (see ``WHOOSHEE_READ_ONLY``)
+        search them. Segment files are never changed once written, so only
+        the ones the replica doesn't have yet are copied; the table of
+        contents of the generation is copied last and renamed into place, so
+        the replicas never see a partial generation. Files of the older
+        generations are removed afterwards. Returns the number of indexes
+        with a new generation.
+
+        :param path: The ``WHOOSHEE_DIR`` of the replicas.
+        """
+        app = _get_app(self)
+        published = 0
+        for wh, partition in self._index_locations(app):
+            index = type(self).get_or_create_index(app, wh, partition)
+            target = os.path.join(path, type(self)._index_subdir(wh, partition))
+            if _publish_generation(index.storage, index.indexname, target) is not None:
+                published += 1
+        return published
+
+    def _index_locations(self, app):
+        # (whoosheer, partition) of every existing index
+        for wh in self.whoosheers:
+            if wh.partition_by:
+                for partition in type(self)._partitions(app, wh):
+                    yield wh, partition
+            else:
+                yield wh, None
+
+    def snapshot(self, path):
+        """Captures the latest committed generation of every index in the
+        new directory ``path``. The files of the generation are hardlinked
+        (copied if that's not possible), as they never change once written,
+        so taking a snapshot is fast and doesn't block the writers. The
+        snapshot is described by ``manifest.json``; restore it with
+        :meth:`restore`.
+
+        :param path: The directory to create the snapshot in.
+        """
+        app = _get_app(self)
+        # changes made while the snapshot is taken are caught up on restore
+        manifest = {'created': datetime.datetime.utcnow().strftime(_SNAPSHOT_TIME_FORMAT),
+                    'indexes': {}}
+        os.makedirs(path)
+        for wh, partition in self._index_locations(app):
+            index = type(self).get_or_create_index(app, wh, partition)
+            subdir = type(self)._index_subdir(wh, partition)
+            directory = os.path.join(path, subdir)
+            toc = _publish_generation(index.storage, index.indexname, directory, link=True)
+            manifest['indexes'][subdir] = {
+                'generation': toc.generation,
+                'files': sorted(name for name in os.listdir(directory) if not name.startswith('.')),
+            }
+        with open(os.path.join(path, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        return manifest
+
+    def restore(self, path, catch_up=None):
+        """Replaces the indexes by the snapshot in ``path`` taken by
+        :meth:`snapshot`, hardlinking its files (or replacing the files of
+        the database storage in a single transaction), and catches up with
+        the changes made since the snapshot. The write locks of the indexes
+        are held meanwhile, :class:`whoosh.index.LockError` is raised if
+        they aren't released within ``WHOOSHEE_WRITER_TIMEOUT``.
+
+        :param path: The directory of the snapshot.
+        :param catch_up: A callable getting the (UTC) time the snapshot was
+                         taken and returning the ``(model name, primary key,
+                         operation)`` changes made since then, e.g. from an
+                         audit table or ``updated_at`` columns. The changed
+                         records are loaded from the database and indexed.
+                         Without it, the indexes are left as they were when
+                         the snapshot was taken.
+        :return: The number of caught up changes.
+        """
+        self._assure_writable()
+        app = _get_app(self)
+        config = _get_config(self)
+        with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        restored_partitions = {}
+        for wh in self.whoosheers:
+            subdir = type(self)._index_subdir(wh)
+            if wh.partition_by:
+                # a snapshot without any partition of the whoosheer is fine
+                restored_partitions[wh] = sorted(_dir_partition(name[len(subdir) + 1:])
+                                                 for name in manifest['indexes']
+                                                 if name.startswith(subdir + '/'))
+            elif subdir in manifest['indexes']:
+                restored_partitions[wh] = [None]
+            else:
+                raise ValueError('The snapshot in {0} has no index {1}'.format(path, subdir))
+        _assure_own_process(config)
+        for wh in self.whoosheers:
+            # the writers committing meanwhile would write to the replaced indexes
+            with self._locked_indexes(app, wh):
+                self._restore_index(app, wh, path, manifest, restored_partitions[wh])
+                self._forget_indexes(wh)
+                if config['memory_storage']:
+                    for partition in restored_partitions[wh]:
+                        subdir = type(self)._index_subdir(wh, partition)
+                        config['whoosheers_indexes'][_index_key(wh, partition)] = \
+                            _load_into_memory(os.path.join(path, subdir),
+                                              manifest['indexes'][subdir]['files'])
+        if catch_up is None:
+            return 0
+        created = datetime.datetime.strptime(manifest['created'], _SNAPSHOT_TIME_FORMAT)
+        changes = list(catch_up(created))
+        if changes:
+            self._index_keys(changes)
+        return len(changes)
+
+    @contextmanager
+    def _locked_indexes(self, app, wh):
+        """Holds the write locks of all the existing indexes (partitions) of
+        the whoosheer, see `_write_lock`."""
+        config = _get_config(self)
+        partitions = type(self)._partitions(app, wh) if wh.partition_by else [None]
+        if config['memory_storage']:
+            storages = [index.storage for key, index in list(config['whoosheers_indexes'].items())
+                        if key is wh or (isinstance(key, tuple) and key[0] is wh)]
+        elif config['database_storage']:
+            storages = [type(self)._database_storage(app, wh, partition).create()
+                        for partition in partitions]
+        else:
+            paths = [type(self)._index_path(app, wh, partition) for partition in partitions]
+            storages = [type(self)._file_storage(app, path) for path in paths
+                        if os.path.isdir(path)]
+        with ExitStack() as stack:
+            for storage in storages:
+                stack.enter_context(_write_lock(storage, config))
+            yield
+
+    def _forget_indexes(self, wh):
+        # drops the cached indexes of the whoosheer and closes their pooled
+        # searchers, the ones in use are closed when released
+        config = _get_config(self)
+        with config['searchers_lock']:
+            keys = list(config['whoosheers_indexes']) + list(config['whoosheers_searchers'])
+            for key in keys:
+                if key is wh or (isinstance(key, tuple) and key[0] is wh):
+                    config['whoosheers_indexes'].pop(key, None)
+                    config['partitions_lru'].pop(key, None)
+                    for searcher in config['whoosheers_searchers'].pop(key, []):
+                        searcher.close()
+
+    def _restore_index(self, app, wh, path, manifest, partitions):
+        # replaces the stored indexes of the whoosheer by the snapshot ones
+        from whoosh.filedb.filestore import FileStorage
+
+        config = _get_config(self)
+        if config['memory_storage']:
+            return
+        if config['database_storage']:
+            self._restore_into_database(app, wh, path, manifest, partitions)
+            return
+        target = type(self)._index_path(app, wh)
+        restored = target + '.restored'
+        replaced = target + '.replaced'
+        shutil.rmtree(restored, ignore_errors=True)
+        os.makedirs(restored)
+        for partition in partitions:
+            subdir = type(self)._index_subdir(wh, partition)
+            directory = restored if partition is None else \
+                os.path.join(restored, _partition_dir(partition))
+            _assure_dirs_exists(directory)
+            source_storage = FileStorage(os.path.join(path, subdir))
+            for name in manifest['indexes'][subdir]['files']:
+                _link_index_file(source_storage, name, directory)
+        if os.path.exists(target):
+            shutil.rmtree(replaced, ignore_errors=True)
+            os.rename(target, replaced)
+        os.rename(restored, target)
+        shutil.rmtree(replaced, ignore_errors=True)
+
+    def _restore_into_database(self, app, wh, path, manifest, partitions):
+        # the files are replaced in a single transaction, so the other nodes never
+        # see a partial index; their caches miss the new file ids
+        subdir = type(self)._index_subdir(wh)
+        engine = _get_engine(app)
+        outbox_metadata.create_all(engine, tables=[files_table, locks_table])
+        with engine.begin() as connection:
+            if wh.partition_by:
+                where = files_table.c.index_name.startswith(subdir + '/', autoescape=True)
+            else:
+                where = files_table.c.index_name == subdir
+            connection.execute(files_table.delete().where(where))
+            for partition in partitions:
+                index_name = type(self)._index_subdir(wh, partition)
+                for name in manifest['indexes'][index_name]['files']:
+                    with open(os.path.join(path, index_name, name), 'rb') as f:
+                        data = f.read()
+                    connection.execute(files_table.insert().values(
+                        index_name=index_name, name=name, size=len(data), modified=time.time(),
+                        data=data))
 
     def reindex(self):
         """Reindex all data
 
         This method retrieves all the data from the registered models and
         calls the ``update_<model>()`` function for every instance of such
-        model.
+        model. The instances of the whoosheers with ``partition_by`` are
+        loaded ordered by the partition, so that a single partition index is
+        written at a time.
         """
+        self._assure_writable()
         for wh in self.whoosheers:
+            if wh.partition_by:
+                self._reindex_partitions(wh)
+                continue
             index = type(self).get_or_create_index(_get_app(self), wh)
-            with index.writer(timeout=_get_config(self)['writer_timeout']) as writer:
+            with _index_writer(index, _get_config(self)) as writer:
                 for model in wh.models:
                     method_name = "{0}_{1}".format(UPDATE_KWD, model.__name__.lower())
                     for item in model.query.all():
                         getattr(wh, method_name)(writer, item)
 
+    def _reindex_partitions(self, wh):
+        for model in wh.models:
+            method = getattr(wh, "{0}_{1}".format(UPDATE_KWD, model.__name__.lower()))
+            writer = partition = None
+            try:
+                for item in model.query.order_by(getattr(model, wh.partition_by)).all():
+                    if writer is None or _partition_of(wh, item) != partition:
+                        if writer:
+                            writer.commit()
+                        partition = _partition_of(wh, item)
+                        index = type(self).get_or_create_index(_get_app(self), wh, partition)
+                        writer = _index_writer(index, _get_config(self))
+                    method(writer, item)
+            except Exception:
+                if writer:
+                    writer.cancel()
+                raise
+            if writer:
+                writer.commit()
+
+
+def _index_batches(whooshee, app, queue, stopped, batch_size, commit_interval):
+    """Indexes the changes of the ``{'changes', 'done', 'error'}`` items
+    put in the queue until ``stopped`` is set, in batches of up to
+    ``batch_size`` changes or whatever arrives within ``commit_interval``
+    seconds. Each item's ``done`` event is set once its batch is indexed."""
+    try:
+        from queue import Empty
+    except ImportError:
+        from Queue import Empty
+
+    while not stopped.is_set():
+        try:
+            items = [queue.get(timeout=0.5)]
+        except Empty:
+            continue
+        count = len(items[0]['changes'])
+        deadline = time.time() + commit_interval
+        while count < batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                item = queue.get(timeout=remaining)
+            except Empty:
+                break
+            items.append(item)
+            count += len(item['changes'])
+        # other errors are bugs and stop the writer, its waiting clients index directly
+        error = 'the indexer stopped'
+        try:
+            with app.app_context():
+                whooshee._index_keys([tuple(change) for item in items
+                                      for change in item['changes']])
+            error = None
+        except _indexing_errors() as err:
+            error = '{0}: {1}'.format(type(err).__name__, err)
+        finally:
+            for item in items:
+                item['error'] = error
+                item['done'].set()
+
+
+class Indexer(object):
+    """A local indexing process serving all the application processes on
+    the host, so that they don't compete for the index locks. It listens on
+    the Unix socket ``WHOOSHEE_INDEXER_SOCKET`` for the changes sent by the
+    processes after their database commits and writes them with a single
+    writer thread, which commits them in batches of up to ``batch_size``
+    changes or whatever arrived within ``commit_interval`` seconds. A change
+    is acknowledged only after its batch is committed.
+
+    Run it with the ``flask whooshee indexer`` command.
+
+    :param whooshee: The :class:`Whooshee` instance.
+    :param app: The application instance.
+    :param socket_path: The socket to listen on, defaults to
+                        ``WHOOSHEE_INDEXER_SOCKET``.
+    :param batch_size: The maximum number of changes committed at once.
+    :param commit_interval: The number of seconds to wait for more changes
+                            before committing a batch.
+    """
+
+    def __init__(self, whooshee, app, socket_path=None, batch_size=1000, commit_interval=0.05):
+        try:
+            import queue
+            import socketserver
+        except ImportError:
+            import Queue as queue
+            import SocketServer as socketserver
+
+        self.whooshee = whooshee
+        self.app = app
+        self.socket_path = socket_path or app.extensions['whooshee']['indexer_socket']
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        indexer = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            """Submits the changes sent by a process and answers once they're
+            indexed."""
+
+            def handle(self):
+                for line in self.rfile:
+                    error = indexer.submit(json.loads(line.decode('utf-8'))['changes'])
+                    response = {'ok': error is None, 'error': error}
+                    self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+        if os.path.exists(self.socket_path):
+            # left behind by an indexer that didn't shut down cleanly
+            os.unlink(self.socket_path)
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self.server.daemon_threads = True
+        self._writer = threading.Thread(target=self._write_batches)
+        self._writer.daemon = True
+
+    def submit(self, changes):
+        """Queues the ``(model name, primary key, operation)`` changes for
+        the writer thread and waits until they are committed. Returns
+        ``None`` or the description of the error that failed the batch."""
+        item = {'changes': changes, 'done': threading.Event(), 'error': None}
+        self._queue.put(item)
+        item['done'].wait()
+        return item['error']
+
+    def _write_batches(self):
+        _index_batches(self.whooshee, self.app, self._queue, self._stopped,
+                       self.batch_size, self.commit_interval)
+
+    def serve_forever(self):
+        """Serves the application processes until :meth:`shutdown`."""
+        self._writer.start()
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """Stops serving (from another thread) and removes the socket."""
+        self.server.shutdown()
+        self.server.server_close()
+        self._stopped.set()
+        self._writer.join()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+class Broadcaster(object):
+    """A local hub keeping the memory storage indexes (see
+    ``WHOOSHEE_MEMORY_STORAGE``) of all the application processes on the
+    host in sync. Every process connects to its Unix socket
+    ``WHOOSHEE_BROADCAST_SOCKET`` once it opens an index, sends it the
+    changes it committed and indexed and gets the changes committed by the
+    other processes, which it indexes in batches in a background thread.
+
+    Run it with the ``flask whooshee broadcaster`` command.
+
+    :param socket_path: The socket to listen on.
+    """
+
+    def __init__(self, socket_path):
+        try:
+            import socketserver
+        except ImportError:
+            import SocketServer as socketserver
+
+        self.socket_path = socket_path
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        broadcaster = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            """Relays the changes sent by a connected process to the others."""
+
+            def handle(self):
+                with broadcaster._lock:
+                    broadcaster._subscribers.add(self.wfile)
+                try:
+                    for line in self.rfile:
+                        broadcaster._relay(line, self.wfile)
+                finally:
+                    with broadcaster._lock:
+                        broadcaster._subscribers.discard(self.wfile)
+
+        if os.path.exists(self.socket_path):
+            # left behind by a broadcaster that didn't shut down cleanly
+            os.unlink(self.socket_path)
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self.server.daemon_threads = True
+
+    def _relay(self, line, sender):
+        with self._lock:
+            for subscriber in list(self._subscribers):
+                if subscriber is sender:
+                    continue
+                try:
+                    subscriber.write(line)
+                    subscriber.flush()
+                except (socket.error, ValueError):
+                    # the process went away, its handler cleans up
+                    self._subscribers.discard(subscriber)
+
+    def serve_forever(self):
+        """Relays the changes between the processes until :meth:`shutdown`."""
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """Stops serving (from another thread) and removes the socket."""
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+class _Subscription(object):
+    """Connection of a process to the :class:`Broadcaster`. A thread reads
+    the changes of the other processes and queues them for another thread
+    indexing them in batches; the connection is reestablished whenever it's
+    lost. Changes made by other processes while disconnected are missed.
+    """
+
+    def __init__(self, whooshee, app, socket_path, batch_size=1000, commit_interval=0.05):
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+
+        self.whooshee = whooshee
+        self.app = app
+        self.socket_path = socket_path
+        self.pid = os.getpid()
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._connected = threading.Event()
+        self._lock = threading.Lock()
+        self._sock = None
+        self._threads = [
+            threading.Thread(target=self._receive),
+            threading.Thread(target=_index_batches, args=(
+                whooshee, app, self._queue, self._stopped, batch_size, commit_interval)),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _receive(self):
+        while not self._stopped.is_set():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except socket.error:
+                sock.close()
+                self._stopped.wait(1)
+                continue
+            with self._lock:
+                self._sock = sock
+            self._connected.set()
+            try:
+                for line in sock.makefile('rb'):
+                    self._queue.put({'changes': json.loads(line.decode('utf-8'))['changes'],
+                                     'done': threading.Event(), 'error': None})
+            except (socket.error, ValueError):
+                pass
+            self._connected.clear()
+            with self._lock:
+                self._sock = None
+            sock.close()
+
+    def wait_connected(self, timeout=None):
+        """Waits until connected to the broadcaster, at most ``timeout``
+        seconds. Returns ``True`` if connected."""
+        return self._connected.wait(timeout)
+
+    def send(self, changes):
+        """Sends the ``(model name, primary key, operation)`` changes to the
+        other processes. Raises :class:`socket.error` if not connected."""
+        with self._lock:
+            if self._sock is None:
+                raise socket.error('not connected to {0}'.format(self.socket_path))
+            self._sock.sendall((json.dumps({'changes': changes}) + '\n').encode('utf-8'))
+
+    def close(self):
+        """Disconnects from the broadcaster and waits for the threads to stop."""
+        self._stopped.set()
+        with self._lock:
+            if self._sock is not None:
+                self._sock.shutdown(socket.SHUT_RDWR)
+        for thread in self._threads:
+            thread.join()
+
 
 class WhoosheeDeprecationWarning(DeprecationWarning):
     pass
@@ -1,13 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import array
+import datetime
+import enum
+import os
 import shutil
+import subprocess
+import sys
 import tempfile
+import threading
+import time
+import warnings
+from decimal import Decimal
 from unittest import TestCase
 import string
 
 from flexmock import flexmock
 import whoosh
-from whoosh.filedb.filestore import RamStorage
+import whoosh.collectors
+import whoosh.fields
+import whoosh.index
+import whoosh.query
+import whoosh.searching
+from whoosh.filedb.filestore import RamStorage, ReadOnlyError
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 try:
@@ -15,8 +30,10 @@ try:
 except ImportError:
     from flask_sqlalchemy import BaseQuery as Query
 from sqlalchemy.orm import Query as SQLAQuery
-from sqlalchemy.sql import text
-from flask_whooshee import AbstractWhoosheer, Whooshee, WhoosheeQuery
+from sqlalchemy.sql import func, select, text
+import flask_whooshee
+from flask_whooshee import AbstractWhoosheer, Broadcaster, Indexer, Whooshee, WhoosheeQuery, files_table, \
+    locks_table, outbox_table
 
 
 class BaseTestCases(object):
@@ -358,6 +375,167 @@ class BaseTestCases(object):
             whoosheer = next(w for w in self.wh.whoosheers if set(w.models) == set([self.Entry]))
             self.assertEqual(len(whoosheer.search('blah blah blah')), 0)
 
+        def test_unscored_search(self):
+            self.db.session.add_all(self.all_inst)
+            self.db.session.commit()
+
+            expected = sorted(e.id for e in self.Entry.query.whooshee_search('chuck').all())
+            self.assertTrue(expected)
+            # records that won't be ordered are found without scoring them
+            flexmock(whoosh.searching.Searcher).should_receive('search').never()
+            found = self.Entry.query.whooshee_search('chuck', order_by_relevance=0).all()
+            self.assertEqual(sorted(e.id for e in found), expected)
+            whoosheer = next(w for w in self.wh.whoosheers if set(w.models) == set([self.Entry]))
+            self.assertEqual(sorted(whoosheer.search('chuck', values_of='id', scored=False)), expected)
+            self.assertEqual(len(whoosheer.search('chuck', values_of='id', scored=False, limit=1)), 1)
+
+        def test_values_of_are_gathered_by_docnums(self):
+            for inst in self.all_inst:
+                # each commit writes a new segment
+                self.db.session.add(inst)
+                self.db.session.commit()
+            self.db.session.delete(self.e1)
+            self.db.session.commit()
+
+            whoosheer = next(w for w in self.wh.whoosheers if set(w.models) == set([self.Entry]))
+            hits = whoosheer.search('chuck')
+            expected = [hit['id'] for hit in hits]
+            hits.searcher.close()
+            self.assertTrue(expected)
+            self.assertEqual(whoosheer.search('chuck', values_of='id'), expected)
+            columns = self.app.extensions['whooshee']['segments_cache'][(whoosheer, None, 'values', 'id')]
+            self.assertTrue(columns)
+            self.assertTrue(all(isinstance(c, array.array) for c in columns.values()))
+
+        def test_search_timeout(self):
+            self.db.session.add_all(self.all_inst)
+            self.db.session.commit()
+            whoosheer = next(w for w in self.wh.whoosheers if set(w.models) == set([self.Entry]))
+            config = self.app.extensions['whooshee']
+
+            found = self.Entry.query.whooshee_search('chuck', timeout=10)
+            self.assertFalse(found.whooshee_truncated)
+            self.assertTrue(found.all())
+
+            flexmock(whoosh.collectors.TimeLimitCollector).should_receive('collect_matches') \
+                .and_raise(whoosh.searching.TimeLimit)
+            found = self.Entry.query.whooshee_search('chuck', timeout=10)
+            self.assertTrue(found.whooshee_truncated)
+            self.assertEqual(found.all(), [])
+            self.assertEqual(config['search_timeouts'], 1)
+
+            # unscored searches stop between the matches
+            matching_docs = whoosheer._matching_docs
+
+            def one_match(searcher, query, allow=None, deadline=None):
+                self.assertTrue(deadline is not None)
+                for docnum in matching_docs(searcher, query, allow):
+                    yield docnum
+                    raise whoosh.searching.TimeLimit
+
+            flexmock(whoosheer).should_receive('_matching_docs').replace_with(one_match)
+            config['search_timeout'] = 10
+            values = whoosheer.search('chuck', values_of='id', scored=False)
+            self.assertTrue(values.truncated)
+            self.assertEqual(len(values), 1)
+            self.assertEqual(config['search_timeouts'], 2)
+
+            # so does the expansion of wildcards
+            query = whoosh.query.Wildcard('title', u'*c*')
+            with Whooshee.searcher(self.app, whoosheer) as searcher:
+                self.assertTrue(flask_whooshee._bound_expansion(query, time.time() + 10)
+                                .matcher(searcher).is_active())
+                self.assertRaises(whoosh.searching.TimeLimit,
+                                  flask_whooshee._bound_expansion(query, time.time() - 1).matcher,
+                                  searcher)
+
+        def test_search_many(self):
+            self.db.session.add_all(self.all_inst)
+            self.db.session.commit()
+            entry_wh = next(w for w in self.wh.whoosheers if set(w.models) == set([self.Entry]))
+            entry_user_wh = next(w for w in self.wh.whoosheers
+                                 if set(w.models) == set([self.Entry, self.User]))
+
+            searches = [
+                {'whoosheer': entry_wh, 'search_string': 'chuck'},
+                {'whoosheer': entry_user_wh, 'search_string': 'chuck', 'values_of': 'user_id'},
+                {'whoosheer': entry_wh, 'search_string': 'blah blah blah', 'limit': 1},
+            ]
+            expected = [
+                entry_wh.search('chuck', values_of='id'),
+                entry_user_wh.search('chuck', values_of='user_id'),
+                entry_wh.search('blah blah blah', values_of='id', limit=1),
+            ]
+            self.assertTrue(all(expected))
+            self.assertEqual(self.wh.search_many(searches), expected)
+            self.assertEqual(self.wh.search_many(searches, parallel=True, max_workers=2), expected)
+            self.assertRaises(ValueError, self.wh.search_many,
+                              [{'whoosheer': entry_wh, 'search_string': 'chuck', 'values_of': ''}])
+
+        def test_iter_search(self):
+            self.db.session.add_all(self.all_inst)
+            self.db.session.commit()
+
+            expected = self.Entry.query.join(self.User).whooshee_search('chuck', order_by_relevance=-1).all()
+            self.assertEqual(len(expected), 3)
+            for batch_size in [1, 2, 100]:
+                found = self.Entry.query.join(self.User).iter_search('chuck', batch_size=batch_size)
+                self.assertEqual(list(found), expected)
+            whoosheer = next(w for w in self.wh.whoosheers if set(w.models) == set([self.Entry, self.User]))
+            found = self.Entry.query.join(self.User).add_columns(self.User.name) \
+                .iter_search('chuck', batch_size=2, whoosheer=whoosheer)
+            self.assertEqual([row[0] for row in found], expected)
+            self.assertEqual(list(self.Entry.query.iter_search('xyzxyz')), [])
+
+        def test_count_and_exists(self):
+            self.db.session.add_all(self.all_inst)
+            self.db.session.commit()
+
+            for search_string in ['chuck', 'blah blah blah', 'xyzxyz']:
+                found = self.Entry.query.whooshee_search(search_string).count()
+                self.assertEqual(self.Entry.query.whooshee_count(search_string), found)
+                self.assertEqual(self.Entry.query.whooshee_exists(search_string), found > 0)
+            self.assertTrue(self.Entry.query.whooshee_count('chuck', estimate=True) > 0)
+
+            # conditions the index can't evaluate are counted by the database
+            query = self.Entry.query.filter(self.Entry.title.like(u'%article%'))
+            found = query.whooshee_search('chuck').count()
+            self.assertTrue(0 < found < self.Entry.query.whooshee_count('chuck'))
+            self.assertEqual(query.whooshee_count('chuck'), found)
+            self.assertFalse(self.Entry.query.filter(self.Entry.title.like(u'%xyz%'))
+                             .whooshee_exists('chuck'))
+            self.assertEqual(self.Entry.query.filter(self.Entry.id > 0)
+                             .whooshee_count('chuck', pushdown_filters=False),
+                             self.Entry.query.whooshee_count('chuck'))
+
+            # so are joins, distinct and grouping
+            entry_wh = self.Entry._whoosheer_
+            Entry, User = self.Entry, self.User
+            joined = Entry.query.join(User, (User.id == Entry.user_id) & (User.name == u'chuck'))
+            self.assertEqual(joined.whooshee_count('chuck', whoosheer=entry_wh), 1)
+            user_ids = Entry.query.with_entities(Entry.user_id)
+            self.assertEqual(user_ids.distinct().whooshee_count('article', whoosheer=entry_wh), 1)
+            grouped = user_ids.group_by(Entry.user_id)
+            self.assertEqual(grouped.whooshee_count('article', whoosheer=entry_wh), 1)
+            having = grouped.having(func.count(Entry.id) > 1)
+            self.assertEqual(having.whooshee_count('chuck', whoosheer=entry_wh), 0)
+            self.assertFalse(having.whooshee_exists('chuck', whoosheer=entry_wh))
+
+            self.db.session.delete(self.e1)
+            self.db.session.commit()
+            self.assertEqual(self.Entry.query.whooshee_count('blah blah blah'),
+                             self.Entry.query.whooshee_search('blah blah blah').count())
+
+        def test_autocomplete(self):
+            self.db.session.add_all(self.all_inst)
+            self.db.session.commit()
+
+            self.assertEqual(self.Entry.whoosh_autocomplete('ar'), [u'article', u'arnold'])
+            self.assertEqual(self.Entry.whoosh_autocomplete('ar', limit=1), [u'article'])
+            self.assertEqual(self.Entry.whoosh_autocomplete('Chuck B'), [u'chuck blah', u'chuck better'])
+            self.assertEqual(self.Entry.whoosh_autocomplete('xyz'), [])
+            self.assertEqual(self.Entry.whoosh_autocomplete(' '), [])
+
         def test_sqlalchemy_aliased(self):
             # make sure that sqlalchemy aliased entities are recognized
             self.db.session.add_all(self.all_inst)
@@ -401,6 +579,48 @@ class BaseTestCases(object):
             found = self.ModelWithNonIntID.query.whooshee_search('LeChuck').all()
             self.assertEqual(len(found), 0)
 
+    class PartitionsTest(TestCase):
+        """Entries of two tenants partitioned by ``tenant``."""
+
+        app_config = {}
+
+        def setUp(self):
+            self.app = Flask(__name__)
+
+            self.tmpdir = tempfile.mkdtemp()
+            self.app.config['WHOOSHEE_DIR'] = self.tmpdir
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            self.app.config['TESTING'] = True
+            self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+            self.app.config.update(self.app_config)
+
+            self.db = SQLAlchemy(self.app)
+            self.wh = Whooshee(self.app)
+            self.config = self.app.extensions['whooshee']
+
+            self.ctx = self.app.app_context()
+            self.ctx.push()
+
+            @self.wh.register_model('title', partition_by='tenant')
+            class Entry(self.db.Model):
+                id = self.db.Column(self.db.Integer, primary_key=True)
+                tenant = self.db.Column(self.db.String)
+                title = self.db.Column(self.db.String)
+
+            self.Entry = Entry
+            self.db.create_all()
+            if self.app_config.get('WHOOSHEE_OUTBOX'):
+                self.wh.create_tables()
+            self.acme = Entry(tenant=u'acme', title=u'chuck norris')
+            self.initech = Entry(tenant=u'initech', title=u'chuck testa')
+            self.db.session.add_all([self.acme, self.initech])
+            self.db.session.commit()
+
+        def tearDown(self):
+            self.db.drop_all()
+            self.ctx.pop()
+            shutil.rmtree(self.tmpdir)
+
 
 class TestsWithApp(BaseTestCases.BaseTest):
 
@@ -422,6 +642,94 @@ class TestsWithInitApp(BaseTestCases.BaseTest):
         self.wh.init_app(self.app)
 
 
+class TestImportTime(TestCase):
+
+    def test_import_doesnt_load_whoosh(self):
+        # whoosh is only needed for searching and indexing, importing flask_whooshee
+        # must not pay for it
+        output = subprocess.check_output(
+            [sys.executable, '-X', 'importtime', '-c', 'import flask_whooshee'],
+            stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)))
+        imported = set(line.split('|')[-1].strip() for line in output.decode().splitlines()
+                       if line.startswith('import time:'))
+        self.assertTrue('flask_whooshee' in imported)
+        for module in ['whoosh.fields', 'whoosh.index', 'whoosh.qparser', 'whoosh.filedb.filestore']:
+            self.assertFalse(module in imported, module)
+
+
+class TestLazyInit(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.index_root = tempfile.mkdtemp()
+        self.app.config['WHOOSHEE_DIR'] = os.path.join(self.index_root, 'whooshee')
+        self.app.config['WHOOSHEE_LAZY'] = True
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title', 'content')
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+            content = self.db.Column(self.db.Text)
+
+        self.Entry = Entry
+        self.db.create_all()
+
+    def tearDown(self):
+        shutil.rmtree(self.index_root, ignore_errors=True)
+        self.db.drop_all()
+        self.ctx.pop()
+
+    def test_lazy_init_doesnt_touch_filesystem(self):
+        self.assertFalse(os.path.exists(self.app.config['WHOOSHEE_DIR']))
+
+        self.db.session.add(self.Entry(title=u'chuck', content=u'norris'))
+        self.db.session.commit()
+
+        self.assertTrue(os.path.isdir(self.app.config['WHOOSHEE_DIR']))
+        self.assertEqual(len(self.Entry.query.whooshee_search('chuck').all()), 1)
+
+    def test_warmup(self):
+        self.db.session.add(self.Entry(title=u'chuck', content=u'norris'))
+        self.db.session.commit()
+
+        self.wh.warmup()
+        self.assertTrue(os.path.isdir(self.app.config['WHOOSHEE_DIR']))
+
+        pool = self.app.extensions['whooshee']['whoosheers_searchers'][self.Entry._whoosheer_]
+        self.assertEqual(len(pool), 1)
+        warm = pool[0]
+
+        # searching reuses the warmed up searcher
+        self.Entry.query.whooshee_search('chuck').all()
+        self.assertEqual(pool, [warm])
+
+    def test_reopens_indexes_after_fork(self):
+        self.db.session.add(self.Entry(title=u'chuck', content=u'norris'))
+        self.db.session.commit()
+        self.wh.warmup()
+
+        config = self.app.extensions['whooshee']
+        wh = self.Entry._whoosheer_
+        index = config['whoosheers_indexes'][wh]
+        searcher = config['whoosheers_searchers'][wh][0]
+
+        # pretend we are a freshly forked worker process
+        config['pid'] = -1
+        self.assertEqual(len(self.Entry.query.whooshee_search('chuck').all()), 1)
+        self.assertTrue(searcher.is_closed)
+        self.assertIsNot(config['whoosheers_indexes'][wh], index)
+
+
 class TestsAppWithMemoryStorage(TestCase):
 
     def setUp(self):
@@ -524,6 +832,1246 @@ class TestsAppWithMemoryStorage(TestCase):
         indexes = self.app.extensions['whooshee']['whoosheers_indexes']
         self.assertTrue(isinstance(indexes[self.EntryUserWhoosheer].storage, RamStorage))
 
+    def test_memory_storage_is_kept_after_fork(self):
+        self.wh.warmup()
+        config = self.app.extensions['whooshee']
+        index = config['whoosheers_indexes'][self.EntryUserWhoosheer]
+        searcher = config['whoosheers_searchers'][self.EntryUserWhoosheer][0]
+
+        # pretend we are a freshly forked worker process
+        config['pid'] = -1
+        found = self.Entry.query.join(self.User).whooshee_search('chuck').all()
+        self.assertEqual(len(found), 3)
+        self.assertIs(config['whoosheers_indexes'][self.EntryUserWhoosheer], index)
+        self.assertFalse(searcher.is_closed)
+
+
+class TestNgram(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.app.config['WHOOSHEE_MEMORY_STORAGE'] = True
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title', 'content', ngram=(2, 4))
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.String, primary_key=True)
+            title = self.db.Column(self.db.String)
+            content = self.db.Column(self.db.Text)
+
+        self.Entry = Entry
+        self.db.create_all()
+
+        self.db.session.add_all([
+            Entry(id=u'e1', title=u'chuck norris', content=u'roundhouse kick'),
+            Entry(id=u'e2', title=u'arnold', content=u'terminator'),
+        ])
+        self.db.session.commit()
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.ctx.pop()
+
+    def test_ngram_schema(self):
+        schema = self.Entry._whoosheer_.schema
+        self.assertTrue(isinstance(schema['title'], whoosh.fields.NGRAMWORDS))
+        self.assertTrue(isinstance(schema['content'], whoosh.fields.NGRAMWORDS))
+
+    def test_ngram_substring_search(self):
+        found = self.Entry.query.whooshee_search('orri').all()
+        self.assertEqual([e.id for e in found], [u'e1'])
+        found = self.Entry.query.whooshee_search('minat').all()
+        self.assertEqual([e.id for e in found], [u'e2'])
+        found = self.Entry.query.whooshee_search('e1 e2').all()
+        self.assertEqual(found, [])
+
+    def test_ngram_search_doesnt_use_wildcards(self):
+        flexmock(self.Entry._whoosheer_).should_call('prep_search_string').\
+            with_args('norris', False).once()
+        self.Entry.query.whooshee_search('norris').all()
+
+
+class TestAutocompleteDisplayValues(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.app.config['WHOOSHEE_MEMORY_STORAGE'] = True
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title', stored=True)
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+
+        self.Entry = Entry
+        self.db.create_all()
+
+        self.db.session.add_all([
+            Entry(title=u'Chuck Norris'),
+            Entry(title=u'Chuck Noland'),
+            Entry(title=u'Arnold'),
+        ])
+        self.db.session.commit()
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.ctx.pop()
+
+    def test_autocomplete_display_values(self):
+        found = self.Entry.whoosh_autocomplete('chuck no', display_field='title')
+        self.assertEqual(sorted(found), [u'Chuck Noland', u'Chuck Norris'])
+        found = self.Entry.whoosh_autocomplete('arn', display_field='title')
+        self.assertEqual(found, [u'Arnold'])
+        found = self.Entry.whoosh_autocomplete('no', display_field='title', limit=1)
+        self.assertEqual(len(found), 1)
+        found = self.Entry.whoosh_autocomplete('arnold no', display_field='title')
+        self.assertEqual(found, [])
+
+
+class Status(enum.Enum):
+    draft = 1
+    published = 2
+
+
+class TestTypedFields(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.app.config['WHOOSHEE_MEMORY_STORAGE'] = True
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title', 'views', 'rating', 'created', 'visible', 'status', 'slug',
+                                typed=True, field_types={'slug': whoosh.fields.ID()},
+                                cached_filters={'visible': whoosh.query.Term('visible', True)})
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+            views = self.db.Column(self.db.Integer)
+            rating = self.db.Column(self.db.Numeric)
+            created = self.db.Column(self.db.Date)
+            visible = self.db.Column(self.db.Boolean)
+            status = self.db.Column(self.db.Enum(Status))
+            slug = self.db.Column(self.db.String)
+
+        self.Entry = Entry
+        self.db.create_all()
+
+        self.db.session.add_all([
+            Entry(title=u'chuck norris', views=100, rating=Decimal('4.5'), created=datetime.date(2020, 1, 1),
+                  visible=True, status=Status.published, slug=u'chuck-norris'),
+            Entry(title=u'arnold', views=5, rating=Decimal('2.0'), created=datetime.date(2021, 6, 1),
+                  visible=False, status=Status.draft, slug=u'arnold'),
+            Entry(title=u'silvester'),
+        ])
+        self.db.session.commit()
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.ctx.pop()
+
+    def _search(self, query):
+        whoosheer = self.Entry._whoosheer_
+        with Whooshee.searcher(self.app, whoosheer) as searcher:
+            return sorted(hit['id'] for hit in searcher.search(query, limit=None))
+
+    def test_typed_schema(self):
+        schema = self.Entry._whoosheer_.schema
+        self.assertTrue(isinstance(schema['title'], whoosh.fields.TEXT))
+        self.assertTrue(isinstance(schema['views'], whoosh.fields.NUMERIC))
+        self.assertTrue(isinstance(schema['rating'], whoosh.fields.NUMERIC))
+        self.assertTrue(isinstance(schema['created'], whoosh.fields.DATETIME))
+        self.assertTrue(isinstance(schema['visible'], whoosh.fields.BOOLEAN))
+        self.assertTrue(isinstance(schema['status'], whoosh.fields.KEYWORD))
+        self.assertTrue(isinstance(schema['slug'], whoosh.fields.ID))
+
+    def test_typed_values_are_filterable(self):
+        self.assertEqual(self._search(whoosh.query.NumericRange('views', 10, None)), [1])
+        self.assertEqual(self._search(whoosh.query.NumericRange('rating', 2.0, 3.0)), [2])
+        self.assertEqual(self._search(whoosh.query.DateRange('created', datetime.datetime(2021, 1, 1), None)), [2])
+        self.assertEqual(self._search(whoosh.query.Term('visible', False)), [2])
+        self.assertEqual(self._search(whoosh.query.Term('status', u'published')), [1])
+        self.assertEqual(self._search(whoosh.query.Term('slug', u'chuck-norris')), [1])
+
+    def test_typed_fields_arent_searched(self):
+        found = self.Entry.query.whooshee_search('chuck').all()
+        self.assertEqual([e.id for e in found], [1])
+        found = self.Entry.query.whooshee_search('published').all()
+        self.assertEqual(found, [])
+
+    def test_filters_are_pushed_down(self):
+        Entry = self.Entry
+        self.db.session.add_all([
+            Entry(title=u'chuck norris ' + str(i), views=i, visible=True, status=Status.draft)
+            for i in range(5)
+        ])
+        self.db.session.commit()
+        # without the pushdown the top hit is filtered out by the database
+        found = Entry.query.filter(Entry.status == Status.published) \
+            .whooshee_search('chuck norris', limit=1, pushdown_filters=False).all()
+        self.assertEqual(found, [])
+        found = Entry.query.filter(Entry.status == Status.published) \
+            .whooshee_search('chuck norris', limit=1).all()
+        self.assertEqual([e.id for e in found], [1])
+        found = Entry.query.filter(Entry.views.between(1, 3), Entry.visible == True) \
+            .whooshee_search('chuck', limit=2, order_by_relevance=-1).all()
+        self.assertEqual(len(found), 2)
+        self.assertTrue(all(1 <= e.views <= 3 for e in found))
+        self.assertEqual(Entry.query.filter(Entry.status == Status.draft).whooshee_count('chuck'), 5)
+
+    def test_cached_filters(self):
+        Entry = self.Entry
+        whoosheer = Entry._whoosheer_
+        self.db.session.add(Entry(title=u'chuck', visible=False))
+        self.db.session.commit()
+        found = Entry.query.whooshee_search('chuck', filters=['visible']).all()
+        self.assertEqual([e.id for e in found], [1])
+        cache = self.app.extensions['whooshee']['segments_cache']
+        key = (whoosheer, None, 'filter', 'visible')
+        segments = dict(cache[key])
+        self.assertTrue(segments)
+        self.assertEqual(whoosheer.search('chuck', values_of='id', filters=['visible']), [1])
+        # the documents of unchanged segments are reused
+        for segid, docs in segments.items():
+            self.assertTrue(cache[key].get(segid, docs) is docs)
+        # new segments are picked up
+        self.db.session.add(Entry(title=u'chuck', visible=True))
+        self.db.session.commit()
+        found = Entry.query.filter(Entry.views > 10) \
+            .whooshee_search('chuck', filters=['visible'], order_by_relevance=-1).all()
+        self.assertEqual([e.id for e in found], [1])
+        found = Entry.query.whooshee_search('chuck', filters=['visible'], order_by_relevance=-1).all()
+        self.assertEqual(sorted(e.id for e in found), [1, 5])
+
+    def test_pushed_down_filters(self):
+        from flask_whooshee import _pushdown_filter
+        Entry = self.Entry
+        whoosheer = Entry._whoosheer_
+
+        def pushdown(*criteria):
+            return _pushdown_filter(Entry.query.filter(*criteria).whereclause, whoosheer)
+
+        self.assertEqual(pushdown(Entry.views > 5), whoosh.query.NumericRange('views', 5, None, True, False))
+        self.assertEqual(pushdown(Entry.id.in_([1, 2])),
+                         whoosh.query.Or([whoosh.query.Term('id', 1), whoosh.query.Term('id', 2)]))
+        self.assertEqual(pushdown(Entry.created <= datetime.date(2021, 1, 1), Entry.visible == False),
+                         whoosh.query.And([
+                             whoosh.query.DateRange('created', None, datetime.datetime(2021, 1, 1)),
+                             whoosh.query.Term('visible', False)]))
+        # text fields, non-integer bounds of integer fields and alternatives are left to the database
+        self.assertEqual(pushdown(Entry.title == u'chuck'), None)
+        self.assertEqual(pushdown(Entry.views < 10.5), None)
+        self.assertEqual(pushdown(self.db.or_(Entry.views == 1, Entry.views == 2)), None)
+
+
+class TestSortBy(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.app.config['WHOOSHEE_MEMORY_STORAGE'] = True
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title', sortable=('title', 'created'))
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+            created = self.db.Column(self.db.DateTime)
+
+        self.Entry = Entry
+        self.db.create_all()
+
+        self.db.session.add_all([
+            Entry(title=u'chuck norris b', created=datetime.datetime(2020, 1, 1)),
+            Entry(title=u'chuck norris c', created=datetime.datetime(2022, 1, 1)),
+            Entry(title=u'chuck norris a', created=datetime.datetime(2021, 1, 1)),
+            Entry(title=u'arnold', created=datetime.datetime(2023, 1, 1)),
+        ])
+        self.db.session.commit()
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.ctx.pop()
+
+    def test_sortable_schema(self):
+        schema = self.Entry._whoosheer_.schema
+        self.assertTrue(schema['title'].column_type is not None)
+        self.assertTrue(isinstance(schema['created'], whoosh.fields.DATETIME))
+        self.assertTrue(schema['created'].column_type is not None)
+        self.assertEqual(self.Entry._whoosheer_.search_fields, ['id', 'title'])
+
+    def test_sort_by(self):
+        found = self.Entry.query.whooshee_search('chuck', sort_by='created').all()
+        self.assertEqual([e.id for e in found], [1, 3, 2])
+        found = self.Entry.query.whooshee_search('chuck', sort_by='created', reverse=True, limit=2).all()
+        self.assertEqual([e.id for e in found], [2, 3])
+        found = self.Entry.query.whooshee_search('chuck', sort_by='title', limit=1).all()
+        self.assertEqual([e.id for e in found], [3])
+
+    def test_sort_by_orders_all_results(self):
+        self.db.session.add_all([
+            self.Entry(title=u'chuck {0}'.format(i), created=datetime.datetime(2000 + i, 1, 1))
+            for i in range(20)])
+        self.db.session.commit()
+        found = self.Entry.query.whooshee_search('chuck', sort_by='created', reverse=True,
+                                                 limit=15).all()
+        created = [e.created for e in found]
+        self.assertEqual(len(created), 15)
+        self.assertEqual(created, sorted(created, reverse=True))
+
+    def test_sort_by_on_whoosheer(self):
+        res = self.Entry._whoosheer_.search('norris', values_of='id', sort_by='created', reverse=True)
+        self.assertEqual(res, [2, 3, 1])
+
+
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.app.config['WHOOSHEE_MEMORY_STORAGE'] = True
+        self.app.config['WHOOSHEE_OUTBOX'] = True
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title')
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+
+        self.Entry = Entry
+        self.db.create_all()
+        self.wh.create_tables()
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.ctx.pop()
+
+    def _outbox(self):
+        return self.db.session.execute(outbox_table.select().order_by(outbox_table.c.id)).fetchall()
+
+    def test_changes_are_indexed_by_drain(self):
+        Entry = self.Entry
+        chuck, arnold = Entry(title=u'chuck norris'), Entry(title=u'arnold')
+        self.db.session.add_all([chuck, arnold])
+        self.db.session.commit()
+        self.assertEqual(Entry.query.whooshee_search('chuck').all(), [])
+        self.assertEqual([(r.model, r.pk, r.operation) for r in self._outbox()],
+                         [('Entry', '1', 'insert'), ('Entry', '2', 'insert')])
+
+        self.assertEqual(self.wh.drain(), 2)
+        self.assertEqual(self._outbox(), [])
+        self.assertEqual(Entry.query.whooshee_search('chuck').all(), [chuck])
+
+        chuck.title = u'chuck norris again'
+        self.db.session.commit()
+        chuck.title = u'silvester'
+        arnold.title = u'arnold schwarzenegger'
+        self.db.session.commit()
+        self.db.session.delete(arnold)
+        self.db.session.commit()
+        self.assertEqual(len(self._outbox()), 4)
+
+        flexmock(self.wh).should_call('_apply_changes').once()
+        self.assertEqual(self.wh.drain(batch_size=10), 4)
+        self.assertEqual(Entry.query.whooshee_search('chuck').all(), [])
+        self.assertEqual(Entry.query.whooshee_search('silvester').all(), [chuck])
+        self.assertEqual(Entry.query.whooshee_search('arnold').all(), [])
+
+    def test_rolled_back_changes_arent_recorded(self):
+        self.db.session.add(self.Entry(title=u'chuck norris'))
+        self.db.session.flush()
+        self.assertEqual(len(self._outbox()), 1)
+        self.db.session.rollback()
+        self.assertEqual(self._outbox(), [])
+
+    def test_drain_command(self):
+        self.db.session.add(self.Entry(title=u'chuck norris'))
+        self.db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['whooshee', 'drain', '--batch-size', '5'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertTrue('Indexed 1 changes.' in result.output)
+        self.assertEqual(len(self.Entry.query.whooshee_search('chuck').all()), 1)
+
+
+class TestIndexer(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.app.config['WHOOSHEE_MEMORY_STORAGE'] = True
+        self.app.config['WHOOSHEE_INDEXER_SOCKET'] = os.path.join(self.tmpdir, 'indexer.sock')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title')
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+
+        self.Entry = Entry
+        self.db.create_all()
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def _start_indexer(self):
+        indexer = Indexer(self.wh, self.app, commit_interval=0.01)
+        thread = threading.Thread(target=indexer.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(indexer.shutdown)
+        return indexer
+
+    def test_changes_are_indexed_by_indexer(self):
+        indexer = self._start_indexer()
+        flexmock(indexer).should_call('submit').twice()
+        chuck = self.Entry(title=u'chuck norris')
+        self.db.session.add_all([chuck, self.Entry(title=u'arnold')])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.db.session.commit()
+        self.assertEqual([str(w.message) for w in caught], [])
+        # committed by the indexer before the commit returned
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [chuck])
+        chuck.title = u'silvester'
+        self.db.session.commit()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [])
+        self.assertEqual(self.Entry.query.whooshee_search('silvester').all(), [chuck])
+
+    def test_rolled_back_changes_arent_sent(self):
+        indexer = self._start_indexer()
+        flexmock(indexer).should_receive('submit').never()
+        self.db.session.add(self.Entry(title=u'chuck norris'))
+        self.db.session.flush()
+        self.db.session.rollback()
+
+    def test_failed_batches_are_reported(self):
+        from queue import Queue
+        queue, stopped = Queue(), threading.Event()
+        item = {'changes': [['Entry', '1', 'insert']], 'done': threading.Event()}
+        queue.put(item)
+        flexmock(self.wh).should_receive('_index_keys').and_raise(whoosh.index.LockError('locked'))
+
+        def stop_after_batch():
+            item['done'].wait()
+            stopped.set()
+
+        thread = threading.Thread(target=stop_after_batch)
+        thread.start()
+        flask_whooshee._index_batches(self.wh, self.app, queue, stopped, 100, 0)
+        thread.join()
+        self.assertEqual(item['error'], 'LockError: locked')
+
+        # a bug stops the writer, but its clients don't wait for it
+        item = {'changes': [['Entry', '1', 'insert']], 'done': threading.Event()}
+        queue.put(item)
+        flexmock(self.wh).should_receive('_index_keys').and_raise(TypeError)
+        with self.assertRaises(TypeError):
+            flask_whooshee._index_batches(self.wh, self.app, queue, threading.Event(), 100, 0)
+        self.assertTrue(item['done'].is_set())
+        self.assertEqual(item['error'], 'the indexer stopped')
+
+    def test_indexes_directly_without_indexer(self):
+        chuck = self.Entry(title=u'chuck norris')
+        self.db.session.add(chuck)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.db.session.commit()
+        self.assertTrue(any('indexer failed' in str(w.message) for w in caught))
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [chuck])
+
+
+class TestJournal(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.app.config['WHOOSHEE_DIR'] = self.tmpdir
+        self.app.config['WHOOSHEE_JOURNAL'] = True
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title')
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+
+        self.Entry = Entry
+        self.db.create_all()
+        self.journal_dir = os.path.join(self.tmpdir, '_journal')
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def _journal_lines(self):
+        with open(self.wh._get_journal().path, 'rb') as f:
+            return f.read().splitlines()
+
+    def test_journal_is_truncated_after_indexing(self):
+        flexmock(os).should_call('fsync').once()
+        chuck = self.Entry(title=u'chuck norris')
+        self.db.session.add_all([chuck, self.Entry(title=u'arnold')])
+        self.db.session.commit()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [chuck])
+        self.assertEqual(self._journal_lines(), [])
+
+    def test_journal_is_truncated_after_rollback(self):
+        self.db.session.add(self.Entry(title=u'chuck norris'))
+        self.db.session.flush()
+        self.assertEqual(len(self._journal_lines()), 1)
+        self.db.session.rollback()
+        self.assertEqual(self._journal_lines(), [])
+
+    def test_changes_of_savepoints(self):
+        chuck = self.Entry(title=u'chuck norris')
+        self.db.session.add(chuck)
+        with self.db.session.begin_nested():
+            arnold = self.Entry(title=u'arnold chuck')
+            self.db.session.add(arnold)
+        # nothing is indexed until the whole transaction commits
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [])
+        savepoint = self.db.session.begin_nested()
+        self.db.session.add(self.Entry(title=u'chuck testa'))
+        self.db.session.flush()
+        savepoint.rollback()
+        self.db.session.commit()
+        found = self.Entry.query.whooshee_search('chuck', order_by_relevance=0).all()
+        self.assertEqual(sorted(e.id for e in found), [chuck.id, arnold.id])
+        self.assertEqual(self._journal_lines(), [])
+
+    def test_failed_changes_stay_in_journal(self):
+        flexmock(self.wh).should_receive('_index_keys').and_raise(whoosh.index.LockError('boom'))
+        self.db.session.add(self.Entry(title=u'chuck norris'))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.db.session.commit()
+        self.assertTrue(any('will be retried: boom' in str(w.message) for w in caught))
+        self.assertEqual(self._journal_lines(), [b'["Entry", "1", "insert"]'])
+        self.assertEqual(self.wh._get_journal().failed, [('Entry', '1', 'insert')])
+
+    def test_replay_journal_of_ended_process(self):
+        self.app.extensions['whooshee']['enable_indexing'] = False
+        chuck = self.Entry(title=u'chuck norris')
+        self.db.session.add(chuck)
+        self.db.session.commit()
+        self.app.extensions['whooshee']['enable_indexing'] = True
+        os.makedirs(self.journal_dir)
+        orphan = os.path.join(self.journal_dir, '1.journal')
+        with open(orphan, 'w') as f:
+            # the last entry was cut short by the crash
+            f.write('["Entry", "1", "insert"]\n["Entry", "1", "upd')
+        self.assertEqual(self.wh.replay_journal(), 1)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [chuck])
+
+
+class TestReplica(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.replica_dir = os.path.join(self.tmpdir, 'replica')
+        self.app.config['WHOOSHEE_DIR'] = os.path.join(self.tmpdir, 'primary')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee()
+        self.wh.init_app(self.app)
+
+        self.replica = Flask(__name__)
+        self.replica.config['WHOOSHEE_DIR'] = self.replica_dir
+        self.replica.config['WHOOSHEE_READ_ONLY'] = True
+        self.wh.init_app(self.replica)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title')
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+
+        self.Entry = Entry
+        self.db.create_all()
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def _replica_search(self, search_string):
+        with self.replica.app_context():
+            return sorted(self.wh.whoosheers[0].search(search_string, values_of='id'))
+
+    def test_replica_searches_published_generations(self):
+        self.db.session.add(self.Entry(title=u'chuck norris'))
+        self.db.session.commit()
+        self.assertEqual(self.wh.publish(self.replica_dir), 1)
+        self.assertEqual(self._replica_search('chuck'), [1])
+        # nothing new to publish
+        self.assertEqual(self.wh.publish(self.replica_dir), 0)
+
+        self.db.session.add(self.Entry(title=u'chuck bronson'))
+        self.db.session.commit()
+        self.assertEqual(self.wh.publish(self.replica_dir), 1)
+        # the pooled searcher is refreshed
+        self.assertEqual(self._replica_search('chuck'), [1, 2])
+
+        replica_files = sorted(os.listdir(os.path.join(self.replica_dir, 'entry')))
+        self.assertEqual(len([name for name in replica_files if name.endswith('.toc')]), 1)
+        self.assertFalse([name for name in replica_files if 'LOCK' in name or name.startswith('.')])
+
+    def test_replica_never_writes(self):
+        with self.replica.app_context():
+            self.assertRaises(whoosh.index.EmptyIndexError, self.wh.whoosheers[0].search, 'chuck')
+            self.assertFalse(os.path.exists(self.replica_dir))
+            self.assertRaises(ReadOnlyError, self.wh.reindex)
+        self.assertFalse(os.path.exists(self.replica_dir))
+
+
+class TestSnapshot(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.snapshot_dir = os.path.join(self.tmpdir, 'snapshot')
+        self.app.config['WHOOSHEE_DIR'] = os.path.join(self.tmpdir, 'indexes')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title')
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+
+        self.Entry = Entry
+        self.db.create_all()
+
+        self.chuck = self.Entry(title=u'chuck norris')
+        self.db.session.add(self.chuck)
+        self.db.session.commit()
+        self.manifest = self.wh.snapshot(self.snapshot_dir)
+        self.bronson = self.Entry(title=u'chuck bronson')
+        self.db.session.add(self.bronson)
+        self.db.session.commit()
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_snapshot_hardlinks_files(self):
+        files = self.manifest['indexes']['entry']['files']
+        self.assertTrue(any(name.endswith('.toc') for name in files))
+        self.assertTrue(os.path.exists(os.path.join(self.snapshot_dir, 'manifest.json')))
+        for name in files:
+            if name.endswith('.seg'):
+                self.assertTrue(os.stat(os.path.join(self.snapshot_dir, 'entry', name)).st_nlink > 1)
+
+    def test_restore(self):
+        self.assertEqual(len(self.Entry.query.whooshee_search('chuck').all()), 2)
+        self.assertEqual(self.wh.restore(self.snapshot_dir), 0)
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [self.chuck])
+        # the restored index keeps working
+        self.db.session.delete(self.chuck)
+        self.db.session.commit()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [])
+
+    def test_restore_waits_for_writers(self):
+        wh = self.wh.whoosheers[0]
+        self.app.extensions['whooshee']['writer_timeout'] = 0.1
+        writer = Whooshee.get_or_create_index(self.app, wh).writer()
+        self.assertRaises(whoosh.index.LockError, self.wh.restore, self.snapshot_dir)
+        self.assertEqual(len(self.Entry.query.whooshee_search('chuck').all()), 2)
+        writer.cancel()
+        searcher = Whooshee.get_searcher(self.app, wh)
+        self.wh.restore(self.snapshot_dir)
+        # the searchers of the replaced index aren't used anymore
+        Whooshee.release_searcher(self.app, wh, searcher)
+        self.assertTrue(searcher.is_closed)
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [self.chuck])
+
+    def test_restore_catches_up(self):
+        def catch_up(created):
+            self.assertTrue(isinstance(created, datetime.datetime))
+            return [('Entry', self.bronson.id, 'insert')]
+
+        self.assertEqual(self.wh.restore(self.snapshot_dir, catch_up=catch_up), 1)
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').order_by(self.Entry.id).all(),
+                         [self.chuck, self.bronson])
+
+    def test_restore_into_memory(self):
+        self.app.extensions['whooshee']['memory_storage'] = True
+        self.wh.restore(self.snapshot_dir)
+        self.assertTrue(isinstance(Whooshee.get_or_create_index(self.app, self.wh.whoosheers[0]).storage,
+                                   RamStorage))
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [self.chuck])
+
+
+class TestBroadcaster(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        socket_path = os.path.join(self.tmpdir, 'broadcast.sock')
+        self.broadcaster = Broadcaster(socket_path)
+        thread = threading.Thread(target=self.broadcaster.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.broadcaster.shutdown)
+
+        self.db = SQLAlchemy()
+        self.wh = Whooshee()
+        # two processes sharing the database
+        self.apps = []
+        for _ in range(2):
+            app = Flask(__name__)
+            app.config['WHOOSHEE_MEMORY_STORAGE'] = True
+            app.config['WHOOSHEE_BROADCAST_SOCKET'] = socket_path
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(self.tmpdir, 'db.sqlite')
+            app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+            self.db.init_app(app)
+            self.wh.init_app(app)
+            self.apps.append(app)
+
+        @self.wh.register_model('title')
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+
+        self.Entry = Entry
+        for app in self.apps:
+            with app.app_context():
+                self.db.create_all()
+                # opening the index subscribes to the changes
+                Whooshee.get_or_create_index(app, self.wh.whoosheers[0])
+                self.assertTrue(app.extensions['whooshee']['subscription'].wait_connected(5))
+
+    def tearDown(self):
+        for app in self.apps:
+            app.extensions['whooshee']['subscription'].close()
+        with self.apps[0].app_context():
+            self.db.drop_all()
+            self.db.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def _search(self, app, search_string):
+        with app.app_context():
+            return self.wh.whoosheers[0].search(search_string, values_of='id')
+
+    def _wait_for(self, app, search_string, expected):
+        deadline = time.time() + 5
+        while self._search(app, search_string) != expected and time.time() < deadline:
+            time.sleep(0.01)
+        return self._search(app, search_string)
+
+    def test_changes_reach_other_processes(self):
+        with self.apps[0].app_context():
+            chuck = self.Entry(title=u'chuck norris')
+            self.db.session.add(chuck)
+            self.db.session.commit()
+            self.assertEqual(self._search(self.apps[0], 'chuck'), [1])
+            chuck.title = u'arnold'
+            self.db.session.commit()
+        self.assertEqual(self._wait_for(self.apps[1], 'arnold', [1]), [1])
+        self.assertEqual(self._search(self.apps[1], 'chuck'), [])
+
+    def test_memory_indexes_dont_share_temporary_files(self):
+        writers = [Whooshee.get_or_create_index(app, self.wh.whoosheers[0]).writer()
+                   for app in self.apps]
+        try:
+            self.assertNotEqual(writers[0].temp_storage().folder, writers[1].temp_storage().folder)
+        finally:
+            for writer in writers:
+                writer.cancel()
+
+    def test_rolled_back_changes_arent_broadcast(self):
+        flexmock(self.apps[0].extensions['whooshee']['subscription']).should_receive('send').never()
+        with self.apps[0].app_context():
+            self.db.session.add(self.Entry(title=u'chuck norris'))
+            self.db.session.flush()
+            self.db.session.rollback()
+
+
+class TestMemoryBootstrap(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.app.config['WHOOSHEE_DIR'] = os.path.join(self.tmpdir, 'indexes')
+        self.app.config['WHOOSHEE_MEMORY_STORAGE'] = True
+        self.app.config['WHOOSHEE_ENABLE_INDEXING'] = False
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+        self.config = self.app.extensions['whooshee']
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title')
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+
+        self.Entry = Entry
+        self.db.create_all()
+        self.db.session.add_all([self.Entry(title=u'chuck {0}'.format(i)) for i in range(5)])
+        self.db.session.commit()
+        self.config['enable_indexing'] = True
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def _index(self):
+        return Whooshee.get_or_create_index(self.app, self.wh.whoosheers[0])
+
+    def _search(self):
+        return sorted(self.wh.whoosheers[0].search('chuck', values_of='id'))
+
+    def test_memory_index_starts_empty(self):
+        self.assertEqual(self._search(), [])
+
+    def test_bootstrap_from_database(self):
+        self.config['memory_bootstrap'] = True
+        self.config['bootstrap_chunk'] = 2
+        self.assertEqual(self._search(), [1, 2, 3, 4, 5])
+        self.assertTrue(isinstance(self._index().storage, RamStorage))
+
+    def test_load_from_snapshot(self):
+        snapshot_dir = os.path.join(self.tmpdir, 'snapshot')
+        self.config['memory_bootstrap'] = True
+        self.wh.snapshot(snapshot_dir)
+        self.config['whoosheers_indexes'].clear()
+        self.config['whoosheers_searchers'].clear()
+        self.config['memory_bootstrap'] = False
+        self.config['memory_snapshot'] = snapshot_dir
+        self.assertEqual(self._search(), [1, 2, 3, 4, 5])
+        self.assertTrue(isinstance(self._index().storage, RamStorage))
+
+    def test_fall_back_to_files_over_limit(self):
+        self.config['memory_bootstrap'] = True
+        self.config['bootstrap_chunk'] = 2
+        self.config['memory_limit'] = 1
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(self._search(), [1, 2, 3, 4, 5])
+        self.assertTrue(any('using file storage instead' in str(w.message) for w in caught))
+        self.assertFalse(isinstance(self._index().storage, RamStorage))
+        self.assertTrue(os.listdir(os.path.join(self.tmpdir, 'indexes', 'entry')))
+
+    def test_snapshot_doesnt_replace_newer_file_index(self):
+        snapshot_dir = os.path.join(self.tmpdir, 'snapshot')
+        self.config['memory_bootstrap'] = True
+        self.wh.snapshot(snapshot_dir)
+        self.config['whoosheers_indexes'].clear()
+        self.config['whoosheers_searchers'].clear()
+        self.config['memory_bootstrap'] = False
+        self.config['memory_snapshot'] = snapshot_dir
+        self.config['memory_limit'] = 1
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self.db.session.add(self.Entry(title=u'chuck norris'))
+            self.db.session.commit()
+            self.assertEqual(self._search(), [1, 2, 3, 4, 5, 6])
+            # another process starting falls back to the same file index
+            self.config['whoosheers_indexes'].clear()
+            self.config['whoosheers_searchers'].clear()
+            self.assertEqual(self._search(), [1, 2, 3, 4, 5, 6])
+
+    def test_searchers_of_moved_index_arent_pooled(self):
+        wh = self.wh.whoosheers[0]
+        searcher = Whooshee.get_searcher(self.app, wh)
+        self.config['memory_limit'] = 1
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self.db.session.add(self.Entry(title=u'chuck norris'))
+            self.db.session.commit()
+        Whooshee.release_searcher(self.app, wh, searcher)
+        self.assertTrue(searcher.is_closed)
+        self.db.session.add(self.Entry(title=u'chuck testa'))
+        self.db.session.commit()
+        self.assertEqual(self._search(), [6, 7])
+
+    def test_index_moved_to_files_once_over_limit(self):
+        self.assertTrue(isinstance(self._index().storage, RamStorage))
+        self.config['memory_limit'] = 1
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self.db.session.add(self.Entry(title=u'chuck norris'))
+            self.db.session.commit()
+        self.assertFalse(isinstance(self._index().storage, RamStorage))
+        self.assertEqual(self._search(), [6])
+
+
+class TestStorageOptions(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.app.config['WHOOSHEE_DIR'] = self.tmpdir
+        self.app.config['WHOOSHEE_STORAGE_OPTIONS'] = {'supports_mmap': False}
+        self.app.config['WHOOSHEE_WRITER_OPTIONS'] = {'limitmb': 32}
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title')
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+
+        self.Entry = Entry
+        self.db.create_all()
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_options_are_passed(self):
+        index = Whooshee.get_or_create_index(self.app, self.wh.whoosheers[0])
+        self.assertFalse(index.storage.supports_mmap)
+        flexmock(index).should_call('writer').with_args(timeout=2, limitmb=32).once()
+        chuck = self.Entry(title=u'chuck norris')
+        self.db.session.add(chuck)
+        self.db.session.commit()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [chuck])
+
+
+class TestDatabaseStorage(TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.app.config['WHOOSHEE_DIR'] = self.tmpdir
+        self.app.config['WHOOSHEE_DATABASE_STORAGE'] = True
+        # the index is written by separate connections, which a file database locks out
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(self.tmpdir, 'db.sqlite')
+        self.app.config['TESTING'] = True
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+        self.db = SQLAlchemy(self.app)
+        self.wh = Whooshee(self.app)
+        self.config = self.app.extensions['whooshee']
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        @self.wh.register_model('title')
+        class Entry(self.db.Model):
+            id = self.db.Column(self.db.Integer, primary_key=True)
+            title = self.db.Column(self.db.String)
+
+        self.Entry = Entry
+        self.db.create_all()
+        self.cache_dir = os.path.join(self.tmpdir, '_cache', 'entry')
+
+    def tearDown(self):
+        self.db.drop_all()
+        self.db.engine.dispose()
+        self.ctx.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def _index(self):
+        return Whooshee.get_or_create_index(self.app, self.wh.whoosheers[0])
+
+    def test_index_is_stored_in_database(self):
+        chuck = self.Entry(title=u'chuck norris')
+        self.db.session.add(chuck)
+        self.db.session.commit()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [chuck])
+        names = self.db.session.execute(files_table.select()).fetchall()
+        self.assertTrue(any(row.name.endswith('.toc') for row in names))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'entry')))
+
+    def test_rolled_back_changes_arent_stored(self):
+        self.db.session.add(self.Entry(title=u'chuck norris'))
+        self.db.session.flush()
+        self.db.session.rollback()
+        self.assertEqual(self.Entry.query.all(), [])
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [])
+
+    def test_other_node_reads_through_cache(self):
+        chuck = self.Entry(title=u'chuck norris')
+        self.db.session.add(chuck)
+        self.db.session.commit()
+        # another node with an empty cache
+        self.config['whoosheers_indexes'].clear()
+        self.config['whoosheers_searchers'].clear()
+        shutil.rmtree(os.path.join(self.tmpdir, '_cache'))
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [chuck])
+        self.assertTrue(os.listdir(self.cache_dir))
+        # the cached files are served without fetching them again
+        storage = self._index().storage
+        flexmock(storage).should_receive('_cache').never()
+        self.config['whoosheers_searchers'].clear()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [chuck])
+
+    def test_restore(self):
+        chuck = self.Entry(title=u'chuck norris')
+        self.db.session.add(chuck)
+        self.db.session.commit()
+        snapshot = os.path.join(self.tmpdir, 'snapshot')
+        self.wh.snapshot(snapshot)
+        self.db.session.add(self.Entry(title=u'chuck testa'))
+        self.db.session.commit()
+        self.wh.restore(snapshot)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'entry')))
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [chuck])
+        # another node with an empty cache
+        self.config['whoosheers_indexes'].clear()
+        shutil.rmtree(os.path.join(self.tmpdir, '_cache'))
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [chuck])
+
+    def test_write_lock(self):
+        lock = self._index().lock('WRITELOCK')
+        self.assertTrue(lock.acquire())
+        self.assertRaises(whoosh.index.LockError, self._index().writer, timeout=0)
+        lock.release()
+        self._index().writer().cancel()
+
+    def test_expired_lock_is_taken_over(self):
+        lock = self._index().lock('WRITELOCK')
+        self.assertTrue(lock.acquire())
+        # left by a crashed writer
+        self.db.session.execute(locks_table.update().values(
+            acquired=datetime.datetime.utcnow() - datetime.timedelta(hours=1)))
+        self.db.session.commit()
+        chuck = self.Entry(title=u'chuck norris')
+        self.db.session.add(chuck)
+        self.db.session.commit()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck').all(), [chuck])
+        # the crashed writer's release doesn't remove the new lock
+        other = self._index().lock('WRITELOCK')
+        self.assertTrue(other.acquire())
+        lock.release()
+        self.assertFalse(self._index().lock('WRITELOCK').acquire())
+        other.release()
+
+    def test_writer_whose_lock_was_taken_over_fails(self):
+        writer = self._index().writer()
+        writer.add_document(id=1, title=u'chuck norris')
+        # another writer took over the lock held for too long
+        self.db.session.execute(locks_table.update().values(owner=u'other'))
+        self.db.session.commit()
+        self.assertRaises(whoosh.index.LockError, writer.commit)
+        self.assertEqual(self.wh.whoosheers[0].search('chuck', values_of='id'), [])
+
+    def test_writer_renews_its_lock(self):
+        writer = self._index().writer()
+        writer.add_document(id=1, title=u'chuck norris')
+        past = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        self.db.session.execute(locks_table.update().values(acquired=past))
+        self.db.session.commit()
+        # every file written renews it
+        self._index().storage.create_file('renewed').close()
+        acquired = self.db.session.execute(select(locks_table.c.acquired)).scalar()
+        self.assertTrue(acquired > past + datetime.timedelta(minutes=30))
+        writer.commit()
+        self.assertEqual(self.wh.whoosheers[0].search('chuck', values_of='id'), [1])
+
+
+class TestPartitions(BaseTestCases.PartitionsTest):
+
+    def test_writes_are_routed_by_partition(self):
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir, 'entry'))), ['acme', 'initech'])
+        self.assertEqual(Whooshee._partitions(self.app, self.wh.whoosheers[0]), ['acme', 'initech'])
+
+    def test_search_opens_only_its_partition(self):
+        self.config['whoosheers_indexes'].clear()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='acme').all(), [self.acme])
+        self.assertEqual(self.Entry.query.whooshee_count('chuck', partition='initech'), 1)
+        self.assertFalse(self.Entry.query.whooshee_exists('testa', partition='acme'))
+        self.assertEqual(list(self.config['whoosheers_indexes']),
+                         [(self.wh.whoosheers[0], u'acme'), (self.wh.whoosheers[0], u'initech')])
+
+    def test_partition_is_required(self):
+        self.assertRaises(ValueError, self.Entry.query.whooshee_search, 'chuck')
+
+    def test_any_partition_value(self):
+        odd = self.Entry(tenant=u'../a.b/c', title=u'chuck odd')
+        untenanted = self.Entry(tenant=None, title=u'chuck nobody')
+        self.db.session.add_all([odd, untenanted])
+        self.db.session.commit()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir, 'entry'))),
+                         ['%2E%2E%2Fa%2Eb%2Fc', '%empty', 'acme', 'initech'])
+        self.assertEqual(Whooshee._partitions(self.app, self.wh.whoosheers[0]),
+                         [u'', u'../a.b/c', u'acme', u'initech'])
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='../a.b/c').all(), [odd])
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='').all(), [untenanted])
+        untenanted.tenant = u'acme'
+        self.db.session.commit()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='').all(), [])
+
+    def test_open_partitions_are_bounded(self):
+        self.config['partition_cache_size'] = 1
+        self.config['whoosheers_indexes'].clear()
+        self.config['partitions_lru'].clear()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='acme').all(), [self.acme])
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='initech').all(), [self.initech])
+        key = (self.wh.whoosheers[0], u'initech')
+        self.assertEqual(list(self.config['whoosheers_indexes']), [key])
+        self.assertEqual(list(self.config['whoosheers_searchers']), [key])
+
+    def test_moved_record_leaves_old_partition(self):
+        self.acme.tenant = u'initech'
+        self.db.session.commit()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='acme').all(), [])
+        self.assertEqual(sorted(e.id for e in self.Entry.query.whooshee_search('chuck', partition='initech')),
+                         [1, 2])
+        self.db.session.delete(self.acme)
+        self.db.session.commit()
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='initech').all(), [self.initech])
+
+    def test_segment_values_are_cached_per_partition(self):
+        whoosheer = self.wh.whoosheers[0]
+        flexmock(flask_whooshee).should_call('_stored_values').twice()
+        for _ in range(3):
+            for tenant in ['acme', 'initech']:
+                whoosheer.search('chuck', values_of='id', partition=tenant)
+        cache = self.config['segments_cache']
+        self.assertTrue((whoosheer, u'acme', 'values', 'id') in cache)
+        self.assertTrue((whoosheer, u'initech', 'values', 'id') in cache)
+        # the values of closed partitions are dropped
+        self.config['partition_cache_size'] = 1
+        del self.config['whoosheers_indexes'][(whoosheer, u'acme')]
+        del self.config['whoosheers_searchers'][(whoosheer, u'acme')]
+        whoosheer.search('chuck', values_of='id', partition='acme')
+        self.assertFalse((whoosheer, u'initech', 'values', 'id') in cache)
+
+    def test_reindex_and_snapshot(self):
+        shutil.rmtree(os.path.join(self.tmpdir, 'entry'))
+        self.config['whoosheers_indexes'].clear()
+        self.config['whoosheers_searchers'].clear()
+        self.wh.reindex()
+        self.assertEqual(self.Entry.query.whooshee_search('norris', partition='acme').all(), [self.acme])
+        snapshot = os.path.join(self.tmpdir, 'snapshot')
+        manifest = self.wh.snapshot(snapshot)
+        self.assertEqual(sorted(manifest['indexes']), ['entry/acme', 'entry/initech'])
+        self.wh.restore(snapshot)
+        self.assertEqual(self.Entry.query.whooshee_search('testa', partition='initech').all(), [self.initech])
+
+
+class TestPartitionsWithOutbox(BaseTestCases.PartitionsTest):
+
+    app_config = {'WHOOSHEE_OUTBOX': True}
+
+    def test_drain_routes_moves_and_deletes(self):
+        self.acme.tenant = u'initech'
+        self.db.session.commit()
+        self.db.session.delete(self.initech)
+        self.db.session.commit()
+        self.assertEqual(self.wh.drain(), 4)
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='acme').all(), [])
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='initech').all(), [self.acme])
+
+
+class TestPartitionsWithJournal(BaseTestCases.PartitionsTest):
+
+    app_config = {'WHOOSHEE_JOURNAL': True}
+
+    def test_moves_and_deletes_are_indexed(self):
+        self.acme.tenant = u'initech'
+        self.db.session.commit()
+        self.db.session.delete(self.initech)
+        self.db.session.commit()
+        self.assertEqual(self.wh._get_journal().take_failed(), [])
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='acme').all(), [])
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='initech').all(), [self.acme])
+
+    def test_replayed_delete_without_partition(self):
+        # e.g. journaled before the record's partition was known
+        self.wh._index_keys([('Entry', '2', 'delete')])
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='initech').all(), [])
+        self.assertEqual(self.Entry.query.whooshee_search('chuck', partition='acme').all(), [self.acme])
+
 
 class TestBigInteger(TestCase):
     # pylint: disable=too-many-instance-attributes